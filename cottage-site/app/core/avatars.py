@@ -0,0 +1,74 @@
+import os
+import re
+import time
+from pathlib import Path
+from typing import Optional
+
+from cachetools import TTLCache
+
+# Avatars live under app/web/static/avatars
+AVATAR_DIR = Path(__file__).resolve().parents[1] / "web" / "static" / "avatars"
+AVATAR_DIR.mkdir(parents=True, exist_ok=True)
+
+# Uploads are always saved as webp; the other extensions are older uploads.
+# Lower rank wins when a user has more than one file.
+_EXT_RANK = {"webp": 0, "png": 1, "jpg": 2, "jpeg": 3}
+_NAME_RE = re.compile(r"^(\d+)\.(webp|png|jpe?g)$")
+
+# user id -> legacy avatar extension, from one directory scan. Rebuilt every
+# _INDEX_TTL seconds so files added by other workers show up.
+_index: dict[int, str] = {}
+_index_built = float("-inf")
+_INDEX_TTL = 30
+
+# user id -> avatar URL, or None when the user has none. Shared by the auth
+# middleware, account pages and chat, which all need it per request/message.
+_url_cache: TTLCache = TTLCache(maxsize=10000, ttl=10)
+_MISSING = object()
+
+
+def invalidate_avatar(user_id: int) -> None:
+    _url_cache.pop(user_id, None)
+
+
+def _legacy_ext(user_id: int) -> Optional[str]:
+    global _index, _index_built
+    now = time.monotonic()
+    if now - _index_built > _INDEX_TTL:
+        index: dict[int, str] = {}
+        with os.scandir(AVATAR_DIR) as it:
+            for entry in it:
+                m = _NAME_RE.match(entry.name)
+                if not m:
+                    continue
+                uid, ext = int(m.group(1)), m.group(2)
+                prev = index.get(uid)
+                if prev is None or _EXT_RANK[ext] < _EXT_RANK[prev]:
+                    index[uid] = ext
+        _index, _index_built = index, now
+    return _index.get(user_id)
+
+
+def _url_for(user_id: int, ext: str) -> Optional[str]:
+    try:
+        mtime = int((AVATAR_DIR / f"{user_id}.{ext}").stat().st_mtime)
+    except OSError:
+        return None
+    return f"/static/avatars/{user_id}.{ext}?v={mtime}"
+
+
+def avatar_url(user_id: Optional[int]) -> Optional[str]:
+    if not user_id:
+        return None
+    url = _url_cache.get(user_id, _MISSING)
+    if url is not _MISSING:
+        return url
+    # Current uploads are {id}.webp; checked first and directly so a fresh
+    # upload from any worker shows up without waiting for the index rebuild
+    url = _url_for(user_id, "webp")
+    if url is None:
+        ext = _legacy_ext(user_id)
+        if ext:
+            url = _url_for(user_id, ext)
+    _url_cache[user_id] = url
+    return url
@@ -4,7 +4,16 @@ from sqlalchemy.orm import DeclarativeBase
 from .config import settings
 
 
-engine = create_async_engine(settings.DATABASE_URL, echo=settings.DEBUG, future=True)
+engine = create_async_engine(
+    settings.DATABASE_URL,
+    echo=settings.DEBUG,
+    future=True,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    # Drop connections the server or a proxy closed while idle
+    pool_pre_ping=True,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+)
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 
 
@@ -1,21 +1,30 @@
 from __future__ import annotations
 
 from datetime import datetime
-from sqlalchemy import String, Integer, DateTime, ForeignKey, UniqueConstraint, func
+from enum import IntEnum
+from sqlalchemy import String, Integer, SmallInteger, DateTime, ForeignKey, Index, UniqueConstraint, func
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.core.db import Base
 
 
+class EntityType(IntEnum):
+    # Stored as SMALLINT in votes/reactions.entity_type
+    THREAD = 1
+    REPLY = 2
+
+
 class Vote(Base):
     __tablename__ = "votes"
+    # uq_vote_unique leads with (entity_type, entity_id), so it also serves the
+    # per-entity score lookups; no separate index needed
     __table_args__ = (
         UniqueConstraint("entity_type", "entity_id", "user_id", name="uq_vote_unique"),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    entity_type: Mapped[str] = mapped_column(String(20), index=True)  # 'thread' or 'reply'
-    entity_id: Mapped[int] = mapped_column(Integer, index=True)
+    entity_type: Mapped[int] = mapped_column(SmallInteger)  # EntityType
+    entity_id: Mapped[int] = mapped_column(Integer)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
     value: Mapped[int] = mapped_column(Integer)  # -1 or +1
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
@@ -25,11 +34,12 @@ class Reaction(Base):
     __tablename__ = "reactions"
     __table_args__ = (
         UniqueConstraint("entity_type", "entity_id", "user_id", "key", name="uq_reaction_unique"),
+        Index("ix_reactions_entity_key", "entity_type", "entity_id", "key"),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    entity_type: Mapped[str] = mapped_column(String(20), index=True)  # 'thread' or 'reply'
-    entity_id: Mapped[int] = mapped_column(Integer, index=True)
+    entity_type: Mapped[int] = mapped_column(SmallInteger)  # EntityType
+    entity_id: Mapped[int] = mapped_column(Integer)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
     key: Mapped[str] = mapped_column(String(32), index=True)  # e.g., '👍'
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
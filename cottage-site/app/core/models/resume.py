@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import Text, DateTime, ForeignKey, func
+from sqlalchemy import Text, LargeBinary, DateTime, ForeignKey, func
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.core.db import Base
@@ -13,5 +13,9 @@ class Resume(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     content: Mapped[str] = mapped_column(Text, default="", nullable=False)
+    # Rendered content, refreshed on every edit
+    content_html: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # blake2b-128 of content, to spot no-op edits
+    content_hash: Mapped[Optional[bytes]] = mapped_column(LargeBinary(16), nullable=True)
     updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     updated_by: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
@@ -3,7 +3,7 @@ from __future__ import annotations
 from datetime import datetime
 from typing import Optional, List
 
-from sqlalchemy import String, Text, DateTime, ForeignKey, func
+from sqlalchemy import String, Text, LargeBinary, DateTime, ForeignKey, Index, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from app.core.db import Base
@@ -11,11 +11,19 @@ from app.core.db import Base
 
 class Reply(Base):
     __tablename__ = "replies"
+    __table_args__ = (
+        # Thread view reads a thread's replies in created_at order
+        Index("ix_replies_thread_created", "thread_id", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    thread_id: Mapped[int] = mapped_column(ForeignKey("threads.id", ondelete="CASCADE"), index=True)
+    thread_id: Mapped[int] = mapped_column(ForeignKey("threads.id", ondelete="CASCADE"))
     user_id: Mapped[Optional[int]] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
-    body: Mapped[str] = mapped_column(Text())
+    body: Mapped[str] = mapped_column(Text(), deferred=True)  # undefer() where rendered
+    # Sanitized HTML of body, rendered on write; NULL for rows predating it
+    body_html: Mapped[Optional[str]] = mapped_column(Text(), nullable=True, deferred=True)
+    # blake2b-128 of body, to spot no-op edits
+    body_hash: Mapped[Optional[bytes]] = mapped_column(LargeBinary(16), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
     # relationships
@@ -24,10 +32,18 @@ class Reply(Base):
 
 class Thread(Base):
     __tablename__ = "threads"
+    __table_args__ = (
+        # Thread listing is newest first
+        Index("ix_threads_created_at", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     title: Mapped[str] = mapped_column(String(200), index=True)
-    body: Mapped[str] = mapped_column(Text())
+    body: Mapped[str] = mapped_column(Text(), deferred=True)  # undefer() where rendered
+    # Sanitized HTML of body, rendered on write; NULL for rows predating it
+    body_html: Mapped[Optional[str]] = mapped_column(Text(), nullable=True, deferred=True)
+    # blake2b-128 of body, to spot no-op edits
+    body_hash: Mapped[Optional[bytes]] = mapped_column(LargeBinary(16), nullable=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
 
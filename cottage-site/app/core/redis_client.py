@@ -9,8 +9,17 @@ _redis: Optional[Redis] = None
 
 async def get_redis() -> Redis:
     global _redis
+    # No await between the check and the assignment, so concurrent callers on
+    # the event loop can't race into creating two clients.
     if _redis is None:
-        _redis = Redis.from_url(settings.REDIS_URL, decode_responses=True)
+        _redis = Redis.from_url(
+            settings.REDIS_URL,
+            decode_responses=True,
+            max_connections=64,
+            health_check_interval=30,
+            socket_keepalive=True,
+            retry_on_timeout=True,
+        )
     return _redis
 
 
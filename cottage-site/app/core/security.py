@@ -1,8 +1,13 @@
-from datetime import datetime, timedelta, timezone
+import functools
+import hashlib
+import time
+from dataclasses import dataclass
+from datetime import timedelta
 from typing import Optional
 
+import jwt
+from cachetools import TTLCache
 from fastapi import HTTPException, Request, status, WebSocket
-from jose import JWTError, jwt
 from passlib.context import CryptContext
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -10,33 +15,98 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.core.config import settings
 from app.core.models.user import User
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Built on first use: only password login/registration needs bcrypt
+@functools.cache
+def _pwd() -> CryptContext:
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# Decoded JWT payloads keyed by a truncated SHA-256 of the token. Entries are
+# short-lived and never served past the token's own expiry.
+_jwt_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
+# Same key for tokens that failed to decode (bad signature, expired, garbage),
+# so a client replaying one skips the verify entirely.
+_bad_jwt_cache: TTLCache = TTLCache(maxsize=10000, ttl=60)
+
+# Settings read on every request, bound once at import
+_COOKIE_NAME = settings.JWT_COOKIE_NAME
+_SECRET = settings.SECRET_KEY
+_ALG = settings.JWT_ALGORITHM
+
+# Built once instead of per decode; aud/iss are never set on our tokens
+_JWT_ALGS = [_ALG]
+_JWT_OPTIONS = {"verify_signature": True, "verify_exp": True, "verify_aud": False, "verify_iss": False}
+
+
+# Lightweight view of the signed-in user (request.state.user, websocket sender).
+# Only the columns templates and routers read; password_hash is never loaded.
+@dataclass(frozen=True, slots=True)
+class AuthUser:
+    id: int
+    email: str
+    name: Optional[str]
+    role: str
+    provider: str
+
+
+# Recently resolved users, keyed by user id. Lets the auth middleware set
+# request.state.user without a DB round-trip.
+_user_cache: TTLCache = TTLCache(maxsize=5000, ttl=60)
+
+
+def invalidate_user_cache(user_id: int) -> None:
+    _user_cache.pop(user_id, None)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return _pwd().verify(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return _pwd().hash(password)
+
+
+_DEFAULT_EXPIRE_SECONDS = settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60
 
 
 def create_access_token(subject: str, expires_delta: Optional[timedelta] = None) -> str:
-    expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode = {"sub": subject, "exp": expire}
-    return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
+    # JWT exp is a plain unix timestamp; no need to go through datetime
+    ttl = int(expires_delta.total_seconds()) if expires_delta else _DEFAULT_EXPIRE_SECONDS
+    to_encode = {"sub": subject, "exp": int(time.time()) + ttl}
+    return jwt.encode(to_encode, _SECRET, algorithm=_ALG)
 
 
 def decode_access_token(token: str) -> Optional[dict]:
-    try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+    key = hashlib.sha256(token.encode()).digest()[:16]
+    now = time.time()
+    payload = _jwt_cache.get(key)
+    if payload is not None and payload["exp"] > now:
         return payload
-    except JWTError:
+    if key in _bad_jwt_cache:
         return None
+    try:
+        payload = jwt.decode(token, _SECRET, algorithms=_JWT_ALGS, options=_JWT_OPTIONS)
+    except jwt.InvalidTokenError:
+        _bad_jwt_cache[key] = True
+        return None
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)) and exp > now:
+        _jwt_cache[key] = payload
+    return payload
+
+
+async def _load_auth_user(session: AsyncSession, user_id: int) -> Optional[AuthUser]:
+    # Only runs on a _user_cache miss. Selects just the AuthUser columns rather
+    # than the full entity; callers pass their own short-lived session, so an
+    # identity-map hit would never happen here anyway.
+    stmt = select(User.id, User.email, User.name, User.role, User.provider).where(User.id == user_id)
+    row = (await session.execute(stmt)).first()
+    return AuthUser(*row) if row else None
 
 
-async def get_user_from_cookie(request: Request, session: AsyncSession) -> Optional[User]:
-    token = request.cookies.get(settings.JWT_COOKIE_NAME)
+async def get_user_from_cookie(request: Request, session: AsyncSession) -> Optional[AuthUser]:
+    token = request.cookies.get(_COOKIE_NAME)
     if not token:
         return None
     payload = decode_access_token(token)
@@ -49,20 +119,23 @@ async def get_user_from_cookie(request: Request, session: AsyncSession) -> Optio
         user_id = int(sub)
     except (TypeError, ValueError):
         return None
-    result = await session.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
+    user = _user_cache.get(user_id)
+    if user is None:
+        user = await _load_auth_user(session, user_id)
+        if user is not None:
+            _user_cache[user_id] = user
     return user
 
 
-async def require_user_api(request: Request, session: AsyncSession) -> User:
+async def require_user_api(request: Request, session: AsyncSession) -> AuthUser:
     user = await get_user_from_cookie(request, session)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
     return user
 
 
-async def get_user_from_websocket(websocket: WebSocket, session: AsyncSession) -> Optional[User]:
-    token = websocket.cookies.get(settings.JWT_COOKIE_NAME)
+async def get_user_from_websocket(websocket: WebSocket, session: AsyncSession) -> Optional[AuthUser]:
+    token = websocket.cookies.get(_COOKIE_NAME)
     if not token:
         return None
     payload = decode_access_token(token)
@@ -75,5 +148,4 @@ async def get_user_from_websocket(websocket: WebSocket, session: AsyncSession) -
         user_id = int(sub)
     except (TypeError, ValueError):
         return None
-    result = await session.execute(select(User).where(User.id == user_id))
-    return result.scalar_one_or_none()
+    return await _load_auth_user(session, user_id)
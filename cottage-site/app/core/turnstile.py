@@ -1,9 +1,39 @@
+import hashlib
 from typing import Optional
 
 import httpx
+from cachetools import TTLCache
 
 from app.core.config import settings
 
+VERIFY_URL = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
+
+_client: Optional[httpx.AsyncClient] = None
+
+# Digests of tokens Cloudflare rejected. Only failures are remembered: tokens
+# are single-use, so a passing result must never be replayed from a cache.
+_rejected_tokens: TTLCache = TTLCache(maxsize=4096, ttl=60)
+
+
+async def get_turnstile_client() -> httpx.AsyncClient:
+    global _client
+    # Shared pooled client so verifications reuse a warm HTTP/2 connection
+    # instead of paying a TCP + TLS handshake per form submit.
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=5,
+            http2=True,
+            limits=httpx.Limits(max_connections=32),
+        )
+    return _client
+
+
+async def close_turnstile_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
 async def verify_turnstile(token: Optional[str], remoteip: Optional[str] = None) -> bool:
     # If not configured, treat as disabled and allow
@@ -11,17 +41,23 @@ async def verify_turnstile(token: Optional[str], remoteip: Optional[str] = None)
         return True
     if not token:
         return False
+    key = hashlib.sha256(token.encode()).digest()[:16]
+    if key in _rejected_tokens:
+        return False
     data = {
         "secret": settings.TURNSTILE_SECRET_KEY,
         "response": token,
     }
     if remoteip:
         data["remoteip"] = remoteip
+    client = await get_turnstile_client()
     try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            r = await client.post("https://challenges.cloudflare.com/turnstile/v0/siteverify", data=data)
-            r.raise_for_status()
-            js = r.json()
-            return bool(js.get("success"))
+        r = await client.post(VERIFY_URL, data=data)
+        r.raise_for_status()
+        js = r.json()
     except Exception:
         return False
+    ok = bool(js.get("success"))
+    if not ok:
+        _rejected_tokens[key] = True
+    return ok
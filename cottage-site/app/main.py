@@ -1,15 +1,19 @@
+from html import escape
 from pathlib import Path
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import HTMLResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.templating import Jinja2Templates
 import traceback
+from cachetools import LRUCache
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from app.core.config import settings
 from app.core.redis_client import get_redis, close_redis
+from app.core.security import invalidate_user_cache
+from app.core.turnstile import get_turnstile_client, close_turnstile_client
 from app.web.routers.home import router as home_router
 from app.web.routers.chat import router as chat_router
 from app.web.routers.ws import router as ws_router
@@ -18,10 +22,9 @@ from app.web.routers.about import router as about_router
 from app.web.routers.resume import router as resume_router
 from app.web.routers.auth import router as auth_router
 from app.middleware.auth import AuthMiddleware
-from sqlalchemy.ext.asyncio import AsyncEngine
-from sqlalchemy.ext.asyncio import create_async_engine
-from app.core.db import Base, AsyncSessionLocal
-from sqlalchemy import select, text
+from app.web.markup import RENDER_VERSION
+from app.core.db import Base, engine
+from sqlalchemy import text
 
 BASE_DIR = Path(__file__).resolve().parent
 
@@ -32,18 +35,18 @@ app.add_middleware(AuthMiddleware)
 # Session middleware (required for OAuth state)
 app.add_middleware(SessionMiddleware, secret_key=settings.SECRET_KEY, same_site="lax", https_only=not settings.DEBUG)
 
-# Static files
-static_dir = BASE_DIR / "web" / "static"
-app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
-
 # Error templates
 templates = Jinja2Templates(directory=str(BASE_DIR / "web" / "templates"))
 
+# Advisory lock id taken around the startup schema changes (any fixed bigint)
+_SCHEMA_LOCK_KEY = 0x636F7474616765  # "cottage"
+
 
 @app.on_event("startup")
 async def on_startup():
   # Initialize Redis connection
   await get_redis()
+  await get_turnstile_client()
   # Create tables if not exist
   # Import models to register mappers
   import app.core.models.user  # noqa: F401
@@ -51,49 +54,124 @@ async def on_startup():
   import app.core.models.category  # noqa: F401
   import app.core.models.interaction  # noqa: F401
   import app.core.models.resume  # noqa: F401
-  engine: AsyncEngine = create_async_engine(settings.DATABASE_URL, echo=settings.DEBUG, future=True)
   async with engine.begin() as conn:
+      # Workers start together; serialize the schema changes below so a
+      # second worker only checks column types (e.g. the entity_type
+      # conversion) after the first one's transaction has committed.
+      # Released when this transaction ends.
+      await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _SCHEMA_LOCK_KEY})
       await conn.run_sync(Base.metadata.create_all)
       # Ensure 'role' column exists on users (best-effort, Postgres-specific)
       try:
           await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS role VARCHAR(20) DEFAULT 'user'"))
       except Exception:
           pass
-  # Seed default categories if none exist
+      # entity_type used to be VARCHAR 'thread'/'reply'; convert to SMALLINT EntityType
+      for table in ("votes", "reactions"):
+          await conn.execute(text(f"""
+              DO $$
+              BEGIN
+                  IF EXISTS (
+                      SELECT 1 FROM information_schema.columns
+                      WHERE table_name = '{table}' AND column_name = 'entity_type' AND data_type = 'character varying'
+                  ) THEN
+                      ALTER TABLE {table} ALTER COLUMN entity_type TYPE SMALLINT
+                          USING (CASE entity_type WHEN 'thread' THEN 1 WHEN 'reply' THEN 2 END);
+                  END IF;
+              END $$
+          """))
+      # Votes/reactions are looked up by (entity_type, entity_id) together;
+      # replace the old single-column indexes (create_all skips existing tables)
+      for stmt in (
+          "DROP INDEX IF EXISTS ix_votes_entity_type",
+          "DROP INDEX IF EXISTS ix_votes_entity_id",
+          "DROP INDEX IF EXISTS ix_reactions_entity_type",
+          "DROP INDEX IF EXISTS ix_reactions_entity_id",
+          "CREATE INDEX IF NOT EXISTS ix_reactions_entity_key ON reactions (entity_type, entity_id, key)",
+          # Replies are listed per thread by created_at; the composite index
+          # covers thread_id-only lookups as well
+          "DROP INDEX IF EXISTS ix_replies_thread_id",
+          "CREATE INDEX IF NOT EXISTS ix_replies_thread_created ON replies (thread_id, created_at)",
+          # Thread listing: newest first, LIMIT 20
+          "CREATE INDEX IF NOT EXISTS ix_threads_created_at ON threads (created_at)",
+          # Rendered markdown stored alongside the source (filled lazily for old rows)
+          "ALTER TABLE threads ADD COLUMN IF NOT EXISTS body_html TEXT",
+          "ALTER TABLE replies ADD COLUMN IF NOT EXISTS body_html TEXT",
+          "ALTER TABLE resume ADD COLUMN IF NOT EXISTS content_html TEXT",
+          # Content digests for skipping no-op edits
+          "ALTER TABLE threads ADD COLUMN IF NOT EXISTS body_hash BYTEA",
+          "ALTER TABLE replies ADD COLUMN IF NOT EXISTS body_hash BYTEA",
+          "ALTER TABLE resume ADD COLUMN IF NOT EXISTS content_hash BYTEA",
+          # Small key/value store for schema and data versions
+          "CREATE TABLE IF NOT EXISTS app_meta (key VARCHAR(64) PRIMARY KEY, value TEXT NOT NULL)",
+      ):
+          await conn.execute(text(stmt))
+      # Stored HTML from an older markdown pipeline: clear it so rows are
+      # re-rendered lazily (forum _ensure_html, resume view)
+      stored = (await conn.execute(text("SELECT value FROM app_meta WHERE key = 'render_version'"))).scalar()
+      if stored != str(RENDER_VERSION):
+          for stmt in (
+              "UPDATE threads SET body_html = NULL WHERE body_html IS NOT NULL",
+              "UPDATE replies SET body_html = NULL WHERE body_html IS NOT NULL",
+              "UPDATE resume SET content_html = NULL WHERE content_html IS NOT NULL",
+          ):
+              await conn.execute(text(stmt))
+          await conn.execute(
+              text("INSERT INTO app_meta (key, value) VALUES ('render_version', :v) ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value"),
+              {"v": str(RENDER_VERSION)},
+          )
+  # Seed defaults from one worker rather than all of them: the first worker
+  # to claim the key runs the (idempotent) seed statements. The key expires
+  # after a minute, so a restart after that seeds again.
+  redis = None
   try:
-      from app.core.models.category import Category
-      from app.core.models.resume import Resume
-      from app.core.models.user import User
-      async with AsyncSessionLocal() as session:
-          result = await session.execute(select(Category).limit(1))
-          exists = result.scalar_one_or_none()
-          if not exists:
-              session.add_all([
-                  Category(name="General", slug="general"),
-                  Category(name="Announcements", slug="announcements"),
-                  Category(name="Show & Tell", slug="show-and-tell"),
-              ])
-              await session.commit()
-          # Seed default resume if not present
-          r = (await session.execute(select(Resume).limit(1))).scalar_one_or_none()
-          if not r:
-              session.add(Resume(content="# Your Name\n\nAdd your resume content here (Markdown supported)."))
-              await session.commit()
-          # Assign owner role based on OWNER_EMAIL env, if set
-          if settings.OWNER_EMAIL:
-              owner_email = settings.OWNER_EMAIL.strip().lower()
-              u = (await session.execute(select(User).where(User.email == owner_email))).scalar_one_or_none()
-              if u and getattr(u, "role", "user") != "owner":
-                  u.role = "owner"
-                  await session.commit()
+      redis = await get_redis()
+      should_seed = await redis.set("startup:seed", "1", nx=True, ex=60)
   except Exception:
-      # Swallow seeding errors in startup path to avoid blocking app
-      pass
+      should_seed = True
+  if should_seed:
+      try:
+          async with engine.begin() as conn:
+              # Default categories, only into an empty table
+              await conn.execute(text("""
+                  INSERT INTO categories (name, slug)
+                  SELECT v.name, v.slug FROM (VALUES
+                      ('General', 'general'),
+                      ('Announcements', 'announcements'),
+                      ('Show & Tell', 'show-and-tell')
+                  ) AS v(name, slug)
+                  WHERE NOT EXISTS (SELECT 1 FROM categories)
+                  ON CONFLICT DO NOTHING
+              """))
+              # Default resume if not present
+              await conn.execute(
+                  text("INSERT INTO resume (content) SELECT :content WHERE NOT EXISTS (SELECT 1 FROM resume)"),
+                  {"content": "# Your Name\n\nAdd your resume content here (Markdown supported)."},
+              )
+              # Assign owner role based on OWNER_EMAIL env, if set
+              promoted = []
+              if settings.OWNER_EMAIL:
+                  owner_email = settings.OWNER_EMAIL.strip().lower()
+                  promoted = (await conn.execute(
+                      text("UPDATE users SET role = 'owner' WHERE email = :email AND role IS DISTINCT FROM 'owner' RETURNING id"),
+                      {"email": owner_email},
+                  )).scalars().all()
+          for user_id in promoted:
+              invalidate_user_cache(user_id)
+      except Exception:
+          # Swallow seeding errors in startup path to avoid blocking app, but
+          # release the key so another worker starting now can retry the seed
+          if redis is not None:
+              try:
+                  await redis.delete("startup:seed")
+              except Exception:
+                  pass
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
   await close_redis()
+  await close_turnstile_client()
 
 
 # Routers
@@ -105,6 +183,11 @@ app.include_router(about_router)
 app.include_router(resume_router)
 app.include_router(auth_router)
 
+# Static files. Mounted after the routers so routes under /static (avatars)
+# take precedence over the catch-all mount.
+static_dir = BASE_DIR / "web" / "static"
+app.mount("/static", StaticFiles(directory=str(static_dir)), name="static")
+
 
 @app.get("/healthz")
 async def healthz():
@@ -115,22 +198,30 @@ async def healthz():
 # Exception Handlers
 # -------------------
 
-@app.exception_handler(HTTPException)
-async def http_exception_handler(request: Request, exc: HTTPException):
-    code = exc.status_code
-    default_messages = {
-        400: "Bad Request",
-        401: "Unauthorized",
-        403: "Forbidden",
-        404: "Page not found",
-        405: "Method Not Allowed",
-        408: "Request Timeout",
-        409: "Conflict",
-        413: "Payload Too Large",
-        415: "Unsupported Media Type",
-        429: "Too Many Requests",
-    }
-    message = (exc.detail or default_messages.get(code) or "Unexpected error") if hasattr(exc, "detail") else default_messages.get(code, "Unexpected error")
+DEFAULT_MESSAGES = {
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Page not found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    409: "Conflict",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    429: "Too Many Requests",
+}
+ERROR_TEMPLATE = templates.get_template("error.html")
+
+# Rendered error pages for signed-out visitors, keyed by (code, message) and
+# stored split around the request line, which is filled in per response so
+# distinct URLs share one entry. The nav shows the signed-in user, so only
+# anonymous renders can be shared. Bodies are cached rather than responses
+# because middleware appends to response headers.
+_error_page_cache: LRUCache = LRUCache(maxsize=256)
+_REQUEST_LINE_MARK = "\x00request-line\x00"
+
+
+def _render_error(request: Request, code: int, message: str, **extra) -> HTMLResponse:
     ctx = {
         "request": request,
         "title": f"{code} Error",
@@ -139,7 +230,27 @@ async def http_exception_handler(request: Request, exc: HTTPException):
         "debug": settings.DEBUG,
         "traceback": None,
     }
-    return templates.TemplateResponse("error.html", ctx, status_code=code)
+    ctx.update(extra)
+    return HTMLResponse(ERROR_TEMPLATE.render(ctx), status_code=code)
+
+
+def _render_http_error(request: Request, code: int, message: str) -> HTMLResponse:
+    if settings.DEBUG or getattr(request.state, "user", None) is not None:
+        return _render_error(request, code, message)
+    key = (code, message)
+    parts = _error_page_cache.get(key)
+    if parts is None:
+        body = _render_error(request, code, message, request_line=_REQUEST_LINE_MARK).body
+        parts = _error_page_cache[key] = body.split(_REQUEST_LINE_MARK.encode())
+    line = escape(f"{request.method} {request.url.path}", quote=False).encode()
+    return HTMLResponse(line.join(parts), status_code=code)
+
+
+@app.exception_handler(HTTPException)
+async def http_exception_handler(request: Request, exc: HTTPException):
+    code = exc.status_code
+    message = (exc.detail or DEFAULT_MESSAGES.get(code) or "Unexpected error") if hasattr(exc, "detail") else DEFAULT_MESSAGES.get(code, "Unexpected error")
+    return _render_http_error(request, code, message)
 
 
 @app.exception_handler(RequestValidationError)
@@ -150,44 +261,15 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     tb = None
     if settings.DEBUG:
         tb = traceback.format_exc()
-    ctx = {
-        "request": request,
-        "title": f"{code} {message}",
-        "code": code,
-        "message": message,
-        "debug": settings.DEBUG,
-        "traceback": tb,
-        "errors": exc.errors(),
-    }
-    return templates.TemplateResponse("error.html", ctx, status_code=code)
+    return _render_error(request, code, message, title=f"{code} {message}", traceback=tb, errors=exc.errors())
 
 
 @app.exception_handler(StarletteHTTPException)
 async def starlette_http_exception_handler(request: Request, exc: StarletteHTTPException):
     # Handle Starlette-level HTTP errors (including 404 for missing routes/static)
     code = exc.status_code
-    default_messages = {
-        400: "Bad Request",
-        401: "Unauthorized",
-        403: "Forbidden",
-        404: "Page not found",
-        405: "Method Not Allowed",
-        408: "Request Timeout",
-        409: "Conflict",
-        413: "Payload Too Large",
-        415: "Unsupported Media Type",
-        429: "Too Many Requests",
-    }
-    message = (getattr(exc, "detail", None) or default_messages.get(code) or "Unexpected error")
-    ctx = {
-        "request": request,
-        "title": f"{code} Error",
-        "code": code,
-        "message": message,
-        "debug": settings.DEBUG,
-        "traceback": None,
-    }
-    return templates.TemplateResponse("error.html", ctx, status_code=code)
+    message = (getattr(exc, "detail", None) or DEFAULT_MESSAGES.get(code) or "Unexpected error")
+    return _render_http_error(request, code, message)
 
 
 # Only install a global 500 handler when NOT in debug mode.
@@ -197,15 +279,7 @@ if not settings.DEBUG:
         code = 500
         message = "An internal server error occurred."
         tb = "".join(traceback.format_exception(None, exc, exc.__traceback__))
-        ctx = {
-            "request": request,
-            "title": f"{code} Error",
-            "code": code,
-            "message": message,
-            "debug": settings.DEBUG,
-            "traceback": tb if settings.DEBUG else None,
-        }
-        return templates.TemplateResponse("error.html", ctx, status_code=code)
+        return _render_error(request, code, message, traceback=tb if settings.DEBUG else None)
 
 
 # Fun 418 endpoint
@@ -1,17 +1,23 @@
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
-from pathlib import Path
-import time
 
+from app.core.avatars import avatar_url
 from app.core.db import AsyncSessionLocal
 from app.core.security import get_user_from_cookie
 
+# Paths that never read request.state.user; skip the DB lookup for them
+_SKIP_PREFIXES = ("/static/", "/healthz")
+_SKIP_PATHS = frozenset({"/favicon.ico"})
+
 
 class AuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         # Default no user
         request.state.user = None
         request.state.avatar_url = None
+        path = request.url.path
+        if path.startswith(_SKIP_PREFIXES) or path in _SKIP_PATHS:
+            return await call_next(request)
         # Create a short-lived DB session to resolve user from cookie
         async with AsyncSessionLocal() as session:
             user = await get_user_from_cookie(request, session)
@@ -19,11 +25,7 @@ class AuthMiddleware(BaseHTTPMiddleware):
             # Compute avatar URL if available
             try:
                 if user and getattr(user, "id", None):
-                    static_dir = Path(__file__).resolve().parent.parent / "web" / "static"
-                    avatar_path = static_dir / "avatars" / f"{user.id}.webp"
-                    if avatar_path.exists():
-                        ts = int(avatar_path.stat().st_mtime)
-                        request.state.avatar_url = f"/static/avatars/{user.id}.webp?v={ts}"
+                    request.state.avatar_url = avatar_url(user.id)
             except Exception:
                 request.state.avatar_url = None
         response = await call_next(request)
@@ -0,0 +1,55 @@
+import re
+import threading
+from html import escape
+from typing import Callable, Optional
+
+from bleach.sanitizer import Cleaner
+
+try:
+    import nh3
+except ImportError:  # optional; falls back to bleach
+    nh3 = None
+
+# Stored body_html/content_html is only re-rendered when missing. Bump this
+# whenever rendering or sanitizing output changes: startup then clears the
+# stored HTML so every row re-renders with the current pipeline on next view.
+RENDER_VERSION = 2
+
+# Markdown output sanitization shared by the forum and resume routers.
+# nh3 (Rust ammonia) when installed, else bleach. Building a bleach Cleaner
+# sets up the html5lib tokenizer and filters, so keep one around instead of
+# paying for it in every bleach.clean() call. Cleaner isn't documented as
+# reentrant, hence one per thread.
+_URL_SCHEMES = ["http", "https", "mailto"]
+
+
+def make_sanitizer(tags: list[str], attributes: dict[str, list[str]]) -> Callable[[str], str]:
+    nh3_tags = set(tags)
+    nh3_attrs = {tag: set(attrs) for tag, attrs in attributes.items()}
+    nh3_schemes = set(_URL_SCHEMES)
+    local = threading.local()
+
+    def sanitize(html: str) -> str:
+        if nh3 is not None:
+            # rel is an allowed attribute, so nh3 must not manage it itself
+            return nh3.clean(html, tags=nh3_tags, attributes=nh3_attrs, link_rel=None, url_schemes=nh3_schemes)
+        cleaner = getattr(local, "cleaner", None)
+        if cleaner is None:
+            cleaner = local.cleaner = Cleaner(tags=tags, attributes=attributes, strip=True, protocols=_URL_SCHEMES)
+        return cleaner.clean(html)
+
+    return sanitize
+
+
+# A single unindented line of printable ASCII without any markdown/HTML
+# syntax characters (or a leading digit, which could start an ordered list)
+# renders to a bare paragraph, so it can skip the parser and the sanitizer.
+# Anything else (NUL, other control or Unicode whitespace characters the
+# parser replaces or strips) takes the full pipeline.
+_MD_SYNTAX_RE = re.compile(r"[*_`#>\[\]!\-+=|~<&\\\"]|^\s|^\d")
+
+
+def plain_paragraph(text: str) -> Optional[str]:
+    if text.isascii() and text.isprintable() and not _MD_SYNTAX_RE.search(text):
+        return "<p>" + escape(text.rstrip(" "), quote=False) + "</p>\n"
+    return None
@@ -1,79 +1,177 @@
+import asyncio
+import functools
+import re
+import stat
 from pathlib import Path
 from typing import Optional
 
-from fastapi import APIRouter, Depends, Form, Request, UploadFile, File
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-from sqlalchemy import select
+from fastapi import APIRouter, Depends, Form, HTTPException, Request
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, Response
+from sqlalchemy import and_, case, exists, or_, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 from authlib.integrations.starlette_client import OAuth
+from starlette.datastructures import UploadFile
 from PIL import Image
 import io
-import time
+import orjson
 
+try:
+    import pyvips
+except (ImportError, OSError):  # optional; OSError when libvips itself is missing
+    pyvips = None
+
+from app.core.avatars import AVATAR_DIR, avatar_url, invalidate_avatar
 from app.core.config import settings
 from app.core.db import get_session
 from app.core.models.user import User
 from app.core.security import (
     create_access_token,
     get_password_hash,
+    invalidate_user_cache,
     verify_password,
 )
 from app.core.turnstile import verify_turnstile
+from app.web.templating import preload, render
 
 router = APIRouter()
 
-TEMPLATES_DIR = Path(__file__).resolve().parent.parent / "templates"
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+preload("login.html", "register.html", "account.html")
+
+
+# Invariant parts of the page contexts; merged with per-request values
+_LOGIN_CTX = {"title": "Login", "turnstile_site_key": settings.TURNSTILE_SITE_KEY}
+_REGISTER_CTX = {"title": "Register", "turnstile_site_key": settings.TURNSTILE_SITE_KEY}
+_ACCOUNT_CTX = {"title": "Account settings"}
+
+# Emails are stored canonical (no whitespace, lower-cased), so lookups can
+# use the plain unique index on users.email
+_EMAIL_TRANS = str.maketrans("", "", " \t\r\n")
+
+
+def _normalize_email(email: str) -> str:
+    return email.translate(_EMAIL_TRANS).lower()
 
-# Avatars live under app/web/static/avatars
-STATIC_DIR = Path(__file__).resolve().parent.parent / "static"
-AVATAR_DIR = STATIC_DIR / "avatars"
-AVATAR_DIR.mkdir(parents=True, exist_ok=True)
 
-# OAuth client (registered only when credentials exist)
+# Shape check only; deliverability is proven by the user signing in
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
+_COOKIE_KW = {
+    "httponly": True,
+    "secure": settings.JWT_COOKIE_SECURE,
+    "samesite": "lax",
+    "max_age": settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    "path": "/",
+}
+
+_AVATAR_MAX_BYTES = 5 * 1024 * 1024
+
+# OAuth clients, registered on first use and only when credentials exist
 oauth = OAuth()
-if settings.GOOGLE_CLIENT_ID and settings.GOOGLE_CLIENT_SECRET:
-    oauth.register(
-        name="google",
-        client_id=settings.GOOGLE_CLIENT_ID,
-        client_secret=settings.GOOGLE_CLIENT_SECRET,
-        server_metadata_url="https://accounts.google.com/.well-known/openid-configuration",
-        client_kwargs={"scope": "openid email profile"},
-    )
-if settings.GITHUB_CLIENT_ID and settings.GITHUB_CLIENT_SECRET:
-    oauth.register(
-        name="github",
-        client_id=settings.GITHUB_CLIENT_ID,
-        client_secret=settings.GITHUB_CLIENT_SECRET,
-        access_token_url="https://github.com/login/oauth/access_token",
-        authorize_url="https://github.com/login/oauth/authorize",
-        api_base_url="https://api.github.com/",
-        client_kwargs={"scope": "read:user user:email"},
-    )
 
-def _find_avatar_file(user_id: int) -> Optional[Path]:
-    for ext in ("webp", "png", "jpg", "jpeg"):
-        p = AVATAR_DIR / f"{user_id}.{ext}"
-        if p.exists():
-            return p
+
+@functools.lru_cache(maxsize=None)
+def _get_oauth_client(provider: str):
+    if provider == "google" and settings.GOOGLE_CLIENT_ID and settings.GOOGLE_CLIENT_SECRET:
+        return oauth.register(
+            name="google",
+            client_id=settings.GOOGLE_CLIENT_ID,
+            client_secret=settings.GOOGLE_CLIENT_SECRET,
+            server_metadata_url="https://accounts.google.com/.well-known/openid-configuration",
+            client_kwargs={"scope": "openid email profile"},
+        )
+    if provider == "github" and settings.GITHUB_CLIENT_ID and settings.GITHUB_CLIENT_SECRET:
+        return oauth.register(
+            name="github",
+            client_id=settings.GITHUB_CLIENT_ID,
+            client_secret=settings.GITHUB_CLIENT_SECRET,
+            access_token_url="https://github.com/login/oauth/access_token",
+            authorize_url="https://github.com/login/oauth/authorize",
+            api_base_url="https://api.github.com/",
+            client_kwargs={"scope": "read:user user:email"},
+        )
     return None
 
 
-def _avatar_url(user_id: int) -> Optional[str]:
-    p = _find_avatar_file(user_id)
-    if not p:
-        return None
-    try:
-        ts = int(p.stat().st_mtime)
-    except Exception:
-        ts = int(time.time())
-    return f"/static/avatars/{p.name}?v={ts}"
+# Hash checked when the account doesn't exist (or has no password) so failed
+# logins all cost one bcrypt verify and don't reveal which emails exist.
+# Built on first use to keep bcrypt out of import.
+@functools.cache
+def _dummy_hash() -> str:
+    return get_password_hash("x" * 16)
+
+
+def _process_avatar(raw: bytes, out_path: Path) -> None:
+    # Center-crop square, 512x512, saved as WEBP. Runs in a worker thread.
+    if pyvips is not None:
+        try:
+            # Shrink-on-load thumbnail: never decodes the full-size image
+            img = pyvips.Image.thumbnail_buffer(raw, 512, height=512, crop="centre")
+            if img.hasalpha():
+                img = img.flatten()
+            img.colourspace("srgb").webpsave(str(out_path), Q=90, effort=4)
+            return
+        except pyvips.Error:
+            pass  # fall back to Pillow below
+    img = Image.open(io.BytesIO(raw))
+    # Let the JPEG decoder downscale while decoding (no-op for other formats)
+    img.draft("RGB", (1024, 1024))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    w, h = img.size
+    side = min(w, h)
+    left = (w - side) // 2
+    top = (h - side) // 2
+    # Crop and resize in a single resample pass
+    img = img.resize((512, 512), resample=Image.LANCZOS, box=(left, top, left + side, top + side))
+    img.save(out_path, format="WEBP", quality=90, method=4)
+
+
+async def _find_oauth_user(session: AsyncSession, provider: str, sub: str, email: Optional[str]) -> Optional[User]:
+    # One query for "linked account, else same email"; the provider match sorts first
+    by_sub = and_(User.provider == provider, User.provider_sub == sub)
+    cond = or_(by_sub, User.email == email) if email else by_sub
+    stmt = select(User).where(cond).order_by(case((by_sub, 0), else_=1)).limit(1)
+    return (await session.execute(stmt)).scalars().first()
+
+
+_OWNER_EMAIL = _normalize_email(settings.OWNER_EMAIL) if settings.OWNER_EMAIL else None
+
+
+def _maybe_promote_owner(user: User) -> bool:
+    # Grant the owner role to the OWNER_EMAIL account; the caller commits
+    if _OWNER_EMAIL and (user.email or "").lower() == _OWNER_EMAIL and user.role != "owner":
+        user.role = "owner"
+        return True
+    return False
+
+
+async def _upsert_oauth_user(session: AsyncSession, provider: str, sub: str, email: Optional[str], name: Optional[str]) -> User:
+    # Find by provider_sub or email fallback
+    user = await _find_oauth_user(session, provider, sub, email)
+    if not user:
+        user = User(email=email or f"{provider}_{sub}@example.com", name=name, provider=provider, provider_sub=sub)
+        session.add(user)
+    elif not user.provider_sub:
+        # Link the provider to an existing email account (unless linked concurrently)
+        await session.execute(
+            update(User)
+            .where(User.id == user.id, User.provider_sub.is_(None))
+            .values(provider=provider, provider_sub=sub)
+        )
+    promoted = _maybe_promote_owner(user)
+    # One commit for insert/link/promotion; the flush assigns user.id
+    await session.commit()
+    if promoted:
+        invalidate_user_cache(user.id)
+    return user
 
 
 @router.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request, "title": "Login", "turnstile_site_key": settings.TURNSTILE_SITE_KEY})
+    return render("login.html", {**_LOGIN_CTX, "request": request})
 
 
 @router.post("/login")
@@ -87,44 +185,41 @@ async def login_submit(
 ):
     # Verify Turnstile first
     if not await verify_turnstile(cf_token):
-        return templates.TemplateResponse(
+        return render(
             "login.html",
-            {"request": request, "title": "Login", "error": "Failed challenge. Please try again.", "turnstile_site_key": settings.TURNSTILE_SITE_KEY},
+            {**_LOGIN_CTX, "request": request, "error": "Failed challenge. Please try again."},
             status_code=400,
         )
-    result = await session.execute(select(User).where(User.email == email.lower()))
+    result = await session.execute(select(User).where(User.email == _normalize_email(email)))
     user = result.scalar_one_or_none()
-    if not user or not user.password_hash or not verify_password(password, user.password_hash):
+    # End the read transaction so the pooled connection isn't held during bcrypt
+    await session.commit()
+    hash_to_check = user.password_hash if (user and user.password_hash) else await asyncio.to_thread(_dummy_hash)
+    # bcrypt is deliberately slow; run it off the event loop
+    ok = await asyncio.to_thread(verify_password, password, hash_to_check)
+    if not user or not user.password_hash or not ok:
         # Re-render with error
-        return templates.TemplateResponse(
+        return render(
             "login.html",
-            {"request": request, "title": "Login", "error": "Invalid email or password.", "turnstile_site_key": settings.TURNSTILE_SITE_KEY},
+            {**_LOGIN_CTX, "request": request, "error": "Invalid email or password."},
             status_code=400,
         )
     # Promote to owner if matches OWNER_EMAIL
     try:
-        if settings.OWNER_EMAIL and (user.email or "").lower() == settings.OWNER_EMAIL.strip().lower() and getattr(user, "role", "user") != "owner":
-            user.role = "owner"
+        if _maybe_promote_owner(user):
             await session.commit()
+            invalidate_user_cache(user.id)
     except Exception:
         pass
     token = create_access_token(str(user.id))
     resp = RedirectResponse(url=next or "/", status_code=302)
-    resp.set_cookie(
-        settings.JWT_COOKIE_NAME,
-        token,
-        httponly=True,
-        secure=settings.JWT_COOKIE_SECURE,
-        samesite="lax",
-        max_age=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-        path="/",
-    )
+    resp.set_cookie(settings.JWT_COOKIE_NAME, token, **_COOKIE_KW)
     return resp
 
 
 @router.get("/register", response_class=HTMLResponse)
 async def register_page(request: Request):
-    return templates.TemplateResponse("register.html", {"request": request, "title": "Register", "turnstile_site_key": settings.TURNSTILE_SITE_KEY})
+    return render("register.html", {**_REGISTER_CTX, "request": request})
 
 
 @router.post("/register")
@@ -138,49 +233,52 @@ async def register_submit(
     session: AsyncSession = Depends(get_session),
 ):
     if not await verify_turnstile(cf_token):
-        return templates.TemplateResponse(
+        return render(
             "register.html",
-            {"request": request, "title": "Register", "error": "Failed challenge. Please try again.", "turnstile_site_key": settings.TURNSTILE_SITE_KEY},
+            {**_REGISTER_CTX, "request": request, "error": "Failed challenge. Please try again."},
             status_code=400,
         )
-    email = email.strip().lower()
+    email = _normalize_email(email)
     if not email or not password:
-        return templates.TemplateResponse(
+        return render(
+            "register.html",
+            {**_REGISTER_CTX, "request": request, "error": "Email and password are required."},
+            status_code=400,
+        )
+    # Reject obviously invalid input before it costs a query
+    if not _EMAIL_RE.match(email):
+        return render(
             "register.html",
-            {"request": request, "title": "Register", "error": "Email and password are required.", "turnstile_site_key": settings.TURNSTILE_SITE_KEY},
+            {**_REGISTER_CTX, "request": request, "error": "Please enter a valid email address."},
+            status_code=400,
+        )
+    if len(password) < 8:
+        return render(
+            "register.html",
+            {**_REGISTER_CTX, "request": request, "error": "Password must be at least 8 characters."},
             status_code=400,
         )
     # Check existing
     result = await session.execute(select(User).where(User.email == email))
     existing = result.scalar_one_or_none()
+    # End the read transaction so the pooled connection isn't held during bcrypt
+    await session.commit()
     if existing:
-        return templates.TemplateResponse(
+        return render(
             "register.html",
-            {"request": request, "title": "Register", "error": "Email is already registered.", "turnstile_site_key": settings.TURNSTILE_SITE_KEY},
+            {**_REGISTER_CTX, "request": request, "error": "Email is already registered."},
             status_code=400,
         )
-    user = User(email=email, name=name or None, password_hash=get_password_hash(password), provider="local")
+    password_hash = await asyncio.to_thread(get_password_hash, password)
+    user = User(email=email, name=name or None, password_hash=password_hash, provider="local")
+    # Promote to owner if matches OWNER_EMAIL; saved with the insert
+    _maybe_promote_owner(user)
     session.add(user)
+    # The insert is the last DB step; user.id is set by the flush, no refresh needed
     await session.commit()
-    await session.refresh(user)
-    # Promote to owner if matches OWNER_EMAIL
-    try:
-        if settings.OWNER_EMAIL and (user.email or "").lower() == settings.OWNER_EMAIL.strip().lower() and getattr(user, "role", "user") != "owner":
-            user.role = "owner"
-            await session.commit()
-    except Exception:
-        pass
     token = create_access_token(str(user.id))
     resp = RedirectResponse(url=next or "/", status_code=302)
-    resp.set_cookie(
-        settings.JWT_COOKIE_NAME,
-        token,
-        httponly=True,
-        secure=settings.JWT_COOKIE_SECURE,
-        samesite="lax",
-        max_age=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
-        path="/",
-    )
+    resp.set_cookie(settings.JWT_COOKIE_NAME, token, **_COOKIE_KW)
     return resp
 
 
@@ -193,111 +291,89 @@ async def logout():
 
 @router.get("/auth/google/login")
 async def google_login(request: Request):
-    if not getattr(oauth, "google", None):
+    client = _get_oauth_client("google")
+    if not client:
         return RedirectResponse(url="/login")
     redirect_uri = str(request.url_for("google_callback"))
     if settings.GOOGLE_REDIRECT_URL and not settings.DEBUG:
         redirect_uri = settings.GOOGLE_REDIRECT_URL
-    return await oauth.google.authorize_redirect(request, redirect_uri)
+    return await client.authorize_redirect(request, redirect_uri)
 
 
 @router.get("/auth/google/callback")
 async def google_callback(request: Request, session: AsyncSession = Depends(get_session)):
-    if not getattr(oauth, "google", None):
+    client = _get_oauth_client("google")
+    if not client:
         return RedirectResponse(url="/login")
-    token = await oauth.google.authorize_access_token(request)
+    token = await client.authorize_access_token(request)
     # Prefer OpenID profile
     userinfo = token.get("userinfo")
     if not userinfo:
-        resp = await oauth.google.get("userinfo", token=token)
-        userinfo = resp.json()
+        resp = await client.get("userinfo", token=token)
+        userinfo = orjson.loads(resp.content)
     sub = str(userinfo.get("sub"))
-    email = (userinfo.get("email") or "").lower()
+    email = _normalize_email(userinfo.get("email") or "")
     name = userinfo.get("name")
 
-    # Find by provider_sub or email fallback
-    result = await session.execute(select(User).where((User.provider == "google") & (User.provider_sub == sub)))
-    user = result.scalar_one_or_none()
-    if not user and email:
-        result = await session.execute(select(User).where(User.email == email))
-        user = result.scalar_one_or_none()
-    if not user:
-        user = User(email=email or f"google_{sub}@example.com", name=name, provider="google", provider_sub=sub)
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
-    else:
-        # Ensure provider fields are stored
-        if not user.provider_sub:
-            user.provider = "google"
-            user.provider_sub = sub
-            await session.commit()
-    # Promote to owner if matches OWNER_EMAIL
-    try:
-        if settings.OWNER_EMAIL and (user.email or "").lower() == settings.OWNER_EMAIL.strip().lower() and getattr(user, "role", "user") != "owner":
-            user.role = "owner"
-            await session.commit()
-    except Exception:
-        pass
+    user = await _upsert_oauth_user(session, "google", sub, email, name)
     jwt_token = create_access_token(str(user.id))
     resp = RedirectResponse(url="/", status_code=302)
-    resp.set_cookie(settings.JWT_COOKIE_NAME, jwt_token, httponly=True, secure=settings.JWT_COOKIE_SECURE, samesite="lax", max_age=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60, path="/")
+    resp.set_cookie(settings.JWT_COOKIE_NAME, jwt_token, **_COOKIE_KW)
     return resp
 
 
 @router.get("/auth/github/login")
 async def github_login(request: Request):
-    if not getattr(oauth, "github", None):
+    client = _get_oauth_client("github")
+    if not client:
         return RedirectResponse(url="/login")
     redirect_uri = str(request.url_for("github_callback"))
     if settings.GITHUB_REDIRECT_URL and not settings.DEBUG:
         redirect_uri = settings.GITHUB_REDIRECT_URL
-    return await oauth.github.authorize_redirect(request, redirect_uri)
+    return await client.authorize_redirect(request, redirect_uri)
+
+
+async def _discard(task: asyncio.Task) -> None:
+    # Cancel and reap a request task whose result isn't needed. Reading the
+    # exception keeps a task that already failed from being logged as
+    # "exception was never retrieved"; asyncio.wait itself never raises it.
+    task.cancel()
+    await asyncio.wait([task])
+    if not task.cancelled():
+        task.exception()
 
 
 @router.get("/auth/github/callback")
 async def github_callback(request: Request, session: AsyncSession = Depends(get_session)):
-    if not getattr(oauth, "github", None):
+    client = _get_oauth_client("github")
+    if not client:
         return RedirectResponse(url="/login")
-    token = await oauth.github.authorize_access_token(request)
-    resp = await oauth.github.get("user", token=token)
-    data = resp.json()
+    token = await client.authorize_access_token(request)
+    # Sometimes GitHub email is private, in which case the primary address comes
+    # from user/emails; request both at once and drop the second if unneeded
+    emails_task = asyncio.create_task(client.get("user/emails", token=token))
+    try:
+        resp = await client.get("user", token=token)
+    except BaseException:
+        await _discard(emails_task)
+        raise
+    data = orjson.loads(resp.content)
     gid = str(data.get("id"))
     name = data.get("name") or data.get("login")
     email = data.get("email") or ""
-    # Sometimes GitHub email is private; fetch primary emails
-    if not email:
-        emails_resp = await oauth.github.get("user/emails", token=token)
-        emails = emails_resp.json() if emails_resp.status_code == 200 else []
+    if email:
+        await _discard(emails_task)
+    else:
+        emails_resp = await emails_task
+        emails = orjson.loads(emails_resp.content) if emails_resp.status_code == 200 else []
         primary = next((e for e in emails if e.get("primary")), None)
         email = (primary or {}).get("email") or ""
-    email = email.lower() if email else None
+    email = _normalize_email(email) if email else None
 
-    result = await session.execute(select(User).where((User.provider == "github") & (User.provider_sub == gid)))
-    user = result.scalar_one_or_none()
-    if not user and email:
-        result = await session.execute(select(User).where(User.email == email))
-        user = result.scalar_one_or_none()
-    if not user:
-        user = User(email=email or f"github_{gid}@example.com", name=name, provider="github", provider_sub=gid)
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
-    else:
-        if not user.provider_sub:
-            user.provider = "github"
-            user.provider_sub = gid
-            await session.commit()
-    # Promote to owner if matches OWNER_EMAIL
-    try:
-        if settings.OWNER_EMAIL and (user.email or "").lower() == settings.OWNER_EMAIL.strip().lower() and getattr(user, "role", "user") != "owner":
-            user.role = "owner"
-            await session.commit()
-    except Exception:
-        pass
+    user = await _upsert_oauth_user(session, "github", gid, email, name)
     jwt_token = create_access_token(str(user.id))
     resp = RedirectResponse(url="/", status_code=302)
-    resp.set_cookie(settings.JWT_COOKIE_NAME, jwt_token, httponly=True, secure=settings.JWT_COOKIE_SECURE, samesite="lax", max_age=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60, path="/")
+    resp.set_cookie(settings.JWT_COOKIE_NAME, jwt_token, **_COOKIE_KW)
     return resp
 
 
@@ -308,11 +384,10 @@ async def account_page(request: Request, session: AsyncSession = Depends(get_ses
         next_url = "/account"
         return RedirectResponse(url=f"/login?next={next_url}")
     # Load fresh user from DB for display
-    result = await session.execute(select(User).where(User.id == request.state.user.id))
-    user = result.scalar_one_or_none()
-    return templates.TemplateResponse(
+    user = await session.get(User, request.state.user.id)
+    return render(
         "account.html",
-        {"request": request, "title": "Account settings", "user": user, "avatar_url": _avatar_url(user.id) if user else None},
+        {**_ACCOUNT_CTX, "request": request, "user": user, "avatar_url": avatar_url(user.id) if user else None},
     )
 
 
@@ -327,46 +402,56 @@ async def account_update_profile(
         return RedirectResponse(url="/login?next=/account", status_code=302)
 
     name = (name or "").strip() or None
-    email = (email or "").strip().lower() or None
+    email = _normalize_email(email or "") or None
 
-    # Load current user
-    result = await session.execute(select(User).where(User.id == request.state.user.id))
-    user = result.scalar_one_or_none()
-    if not user:
-        return RedirectResponse(url="/login", status_code=302)
-
-    # Validate email uniqueness if changed
-    if email and email != (user.email or "").lower():
-        check = await session.execute(select(User).where(User.email == email))
-        existing = check.scalar_one_or_none()
-        if existing and existing.id != user.id:
-            return templates.TemplateResponse(
+    user_id = request.state.user.id
+    values = {}
+    if name is not None:
+        values["name"] = name
+    if email is not None:
+        values["email"] = email
+    if values:
+        # The row is only updated when no other account already uses the new
+        # email. Two concurrent updates to the same email can both pass that
+        # check; the unique index stops the second one.
+        stmt = update(User).where(User.id == user_id)
+        if email is not None:
+            other = aliased(User)
+            stmt = stmt.where(~exists().where(other.email == email, other.id != user_id))
+        try:
+            user = (await session.execute(stmt.values(**values).returning(User))).scalar_one_or_none()
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            user = None
+    else:
+        user = None
+    if user is None:
+        # Nothing to update, or the update matched no row: tell the two apart
+        user = await session.get(User, user_id)
+        if not user:
+            return RedirectResponse(url="/login", status_code=302)
+        if values:
+            return render(
                 "account.html",
                 {
+                    **_ACCOUNT_CTX,
                     "request": request,
-                    "title": "Account settings",
                     "user": user,
                     "profile_error": "Email is already in use.",
                 },
                 status_code=400,
             )
+    invalidate_user_cache(user.id)
 
-    # Apply updates
-    if name is not None:
-        user.name = name
-    if email is not None:
-        user.email = email
-    await session.commit()
-    await session.refresh(user)
-
-    return templates.TemplateResponse(
+    return render(
         "account.html",
         {
+            **_ACCOUNT_CTX,
             "request": request,
-            "title": "Account settings",
             "user": user,
             "profile_success": "Profile updated.",
-            "avatar_url": _avatar_url(user.id),
+            "avatar_url": avatar_url(user.id),
         },
     )
 
@@ -383,18 +468,17 @@ async def account_change_password(
         return RedirectResponse(url="/login?next=/account", status_code=302)
 
     # Load current user
-    result = await session.execute(select(User).where(User.id == request.state.user.id))
-    user = result.scalar_one_or_none()
+    user = await session.get(User, request.state.user.id)
     if not user:
         return RedirectResponse(url="/login", status_code=302)
 
     # Only allow password changes for non-OAuth users
     if (user.provider or "local") != "local":
-        return templates.TemplateResponse(
+        return render(
             "account.html",
             {
+                **_ACCOUNT_CTX,
                 "request": request,
-                "title": "Account settings",
                 "user": user,
                 "password_error": "Password changes are only available for local accounts (non-OAuth).",
             },
@@ -403,36 +487,40 @@ async def account_change_password(
 
     # Validate new password
     if new_password != confirm_password:
-        return templates.TemplateResponse(
+        return render(
             "account.html",
             {
+                **_ACCOUNT_CTX,
                 "request": request,
-                "title": "Account settings",
                 "user": user,
                 "password_error": "New passwords do not match.",
             },
             status_code=400,
         )
     if len(new_password) < 8:
-        return templates.TemplateResponse(
+        return render(
             "account.html",
             {
+                **_ACCOUNT_CTX,
                 "request": request,
-                "title": "Account settings",
                 "user": user,
                 "password_error": "Password must be at least 8 characters.",
             },
             status_code=400,
         )
 
+    # End the read transaction so the pooled connection isn't held during bcrypt
+    await session.commit()
+
     # If user already has a password, verify current_password
     if user.password_hash:
-        if not current_password or not verify_password(current_password, user.password_hash):
-            return templates.TemplateResponse(
+        ok = await asyncio.to_thread(verify_password, current_password or "", user.password_hash)
+        if not current_password or not ok:
+            return render(
                 "account.html",
                 {
+                    **_ACCOUNT_CTX,
                     "request": request,
-                    "title": "Account settings",
                     "user": user,
                     "password_error": "Current password is incorrect.",
                 },
@@ -440,18 +528,17 @@ async def account_change_password(
             )
 
     # Set new password
-    user.password_hash = get_password_hash(new_password)
+    user.password_hash = await asyncio.to_thread(get_password_hash, new_password)
     await session.commit()
-    await session.refresh(user)
 
-    return templates.TemplateResponse(
+    return render(
         "account.html",
         {
+            **_ACCOUNT_CTX,
             "request": request,
-            "title": "Account settings",
             "user": user,
             "password_success": "Password updated.",
-            "avatar_url": _avatar_url(user.id),
+            "avatar_url": avatar_url(user.id),
         },
     )
 
@@ -459,52 +546,78 @@ async def account_change_password(
 @router.post("/account/avatar", response_class=HTMLResponse)
 async def account_update_avatar(
     request: Request,
-    avatar: UploadFile = File(...),
     session: AsyncSession = Depends(get_session),
 ):
     if not getattr(request.state, "user", None):
         return RedirectResponse(url="/login?next=/account", status_code=302)
 
-    result = await session.execute(select(User).where(User.id == request.state.user.id))
-    user = result.scalar_one_or_none()
+    user = await session.get(User, request.state.user.id)
     if not user:
         return RedirectResponse(url="/login", status_code=302)
 
     error = None
     try:
-        content_type = (avatar.content_type or "").lower()
-        if not content_type.startswith("image/"):
-            error = "Please upload an image file."
-            raise ValueError("not image")
-        raw = await avatar.read()
-        if len(raw) > 5 * 1024 * 1024:
+        # Reject from the declared request size before the multipart body is
+        # parsed and spooled, which is why the form is read here rather than
+        # through an UploadFile parameter (slack covers multipart framing)
+        content_length = int(request.headers.get("content-length") or 0)
+        if content_length > _AVATAR_MAX_BYTES + 64 * 1024:
+            error = "Image must be 5MB or smaller."
+            raise ValueError("too large")
+        async with request.form(max_files=1, max_fields=10) as form:
+            avatar = form.get("avatar")
+            if not isinstance(avatar, UploadFile) or not (avatar.content_type or "").lower().startswith("image/"):
+                error = "Please upload an image file."
+                raise ValueError("not image")
+            # Chunked uploads carry no content-length; check the spooled size
+            if (avatar.size or 0) > _AVATAR_MAX_BYTES:
+                error = "Image must be 5MB or smaller."
+                raise ValueError("too large")
+            # Bounded read; the spooled file may be on disk, so not on the event loop
+            raw = await asyncio.to_thread(avatar.file.read, _AVATAR_MAX_BYTES + 1)
+        if len(raw) > _AVATAR_MAX_BYTES:
             error = "Image must be 5MB or smaller."
             raise ValueError("too large")
-        img = Image.open(io.BytesIO(raw))
-        img = img.convert("RGB")
-        # Center-crop square
-        w, h = img.size
-        side = min(w, h)
-        left = (w - side) // 2
-        top = (h - side) // 2
-        img = img.crop((left, top, left + side, top + side))
-        # Resize to 512x512 and save as WEBP
-        img = img.resize((512, 512))
         out_path = AVATAR_DIR / f"{user.id}.webp"
-        img.save(out_path, format="WEBP", quality=90, method=6)
+        # Decode/resize/encode is CPU-bound; keep it off the event loop
+        await asyncio.to_thread(_process_avatar, raw, out_path)
+        invalidate_avatar(user.id)
     except Exception:
         if error is None:
             error = "Failed to process image. Please try a different file."
 
     ctx = {
+        **_ACCOUNT_CTX,
         "request": request,
-        "title": "Account settings",
         "user": user,
-        "avatar_url": _avatar_url(user.id),
+        "avatar_url": avatar_url(user.id),
     }
     if error:
         ctx["avatar_error"] = error
-        return templates.TemplateResponse("account.html", ctx, status_code=400)
+        return render("account.html", ctx, status_code=400)
     else:
         ctx["avatar_success"] = "Profile picture updated."
-        return templates.TemplateResponse("account.html", ctx)
+        return render("account.html", ctx)
+
+
+@router.get("/static/avatars/{fname}", include_in_schema=False)
+async def avatar_file(request: Request, fname: str):
+    # Serves any file in the avatars directory, as the StaticFiles mount did
+    # (uploads plus static images like the home page's). fname is a single
+    # path segment; "." and ".." resolve to directories and are refused below.
+    path = AVATAR_DIR / fname
+    try:
+        st = path.stat()
+    except OSError:
+        raise HTTPException(status_code=404)
+    if not stat.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404)
+    # Avatar URLs carry ?v=<mtime>, so a versioned URL never changes content
+    # and browsers can keep it without revalidating. Unversioned requests
+    # still revalidate against the mtime ETag.
+    etag = f'"{int(st.st_mtime)}"'
+    cache_control = "public, max-age=31536000, immutable" if "v" in request.query_params else "no-cache"
+    headers = {"Cache-Control": cache_control, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers, stat_result=st)
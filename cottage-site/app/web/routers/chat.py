@@ -1,13 +1,11 @@
-from pathlib import Path
 from fastapi import APIRouter, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
 from app.core.config import settings
+from app.web.templating import preload, render
 
 router = APIRouter()
 
-TEMPLATES_DIR = Path(__file__).resolve().parent.parent / "templates"
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+preload("chat.html")
 
 
 @router.get("/chat", response_class=HTMLResponse)
@@ -20,7 +18,7 @@ async def chat_page(request: Request):
             me_avatar = getattr(request.state, "avatar_url", None)
     except Exception:
         pass
-    return templates.TemplateResponse(
+    return render(
         "chat.html",
         {
             "request": request,
@@ -1,24 +1,32 @@
-from pathlib import Path
+import asyncio
+import hashlib
+import re
+from urllib.parse import urlsplit
 from fastapi import APIRouter, Request, Depends, Form, Query
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, desc, func, and_
+from sqlalchemy import select, delete, desc, exists, func, and_, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import undefer
+from cachetools import LRUCache, TTLCache
 from markdown_it import MarkdownIt
-import bleach
 
+from app.core.config import settings
 from app.core.db import get_session
 from app.core.models.thread import Thread, Reply
 from app.core.turnstile import verify_turnstile
 from app.core.models.category import Category, ThreadCategory
-from app.core.models.interaction import Vote, Reaction
+from app.core.models.interaction import EntityType, Vote, Reaction
+from app.web.markup import make_sanitizer, plain_paragraph
+from app.web.templating import preload, render
 
 router = APIRouter()
 
-TEMPLATES_DIR = Path(__file__).resolve().parent.parent / "templates"
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+preload("forum_index.html", "partials/_threads.html", "forum_new.html", "forum_thread.html", "forum_thread_edit.html", "forum_reply_edit.html", "error.html")
 
 # Markdown rendering and sanitization
+# Raw HTML in posts is passed through and left to the sanitizer, which keeps
+# the allowed tags below
 _md = MarkdownIt()
 _ALLOWED_TAGS = [
     "p", "br", "hr", "pre", "code", "blockquote",
@@ -28,9 +36,70 @@ _ALLOWED_TAGS = [
 ]
 _ALLOWED_ATTRS = {"a": ["href", "title", "target", "rel"]}
 
+_sanitize = make_sanitizer(_ALLOWED_TAGS, _ALLOWED_ATTRS)
+
+
+def _body_hash(body: str) -> bytes:
+    # Render cache key, and stored as body_hash so edits can spot an
+    # unchanged body without loading the old one
+    return hashlib.blake2b(body.encode(), digest_size=16).digest()
+
+
+# Sanitized HTML keyed by the body's 16-byte blake2b digest (the same value
+# stored as body_hash). Per process; entries only ever leave by LRU eviction.
+_render_cache: LRUCache = LRUCache(maxsize=10_000)
+
+
 def render_markdown(text: str) -> str:
-    html = _md.render(text or "")
-    return bleach.clean(html, tags=_ALLOWED_TAGS, attributes=_ALLOWED_ATTRS, strip=True)
+    text = text or ""
+    if not text.strip():
+        return ""
+    html = plain_paragraph(text)
+    if html is not None:
+        return html
+    key = _body_hash(text)
+    html = _render_cache.get(key)
+    if html is None:
+        html = _render_cache[key] = _sanitize(_md.render(text))
+    return html
+
+
+async def _ensure_html(session: AsyncSession, thread: Thread | None, replies) -> None:
+    # Rows written before body_html existed: render once and store the result
+    # so later views serve it as-is. Callers load body_html, not body.
+    if thread is not None and thread.body_html is None:
+        await session.refresh(thread, ["body"])
+        thread.body_html = render_markdown(thread.body)
+    missing = [r for r in replies if r.body_html is None]
+    if missing:
+        bodies = dict((await session.execute(
+            select(Reply.id, Reply.body).where(Reply.id.in_([r.id for r in missing]))
+        )).all())
+        for r in missing:
+            r.body_html = render_markdown(bodies.get(r.id))
+    if session.dirty:
+        await session.commit()
+
+
+# Categories are only created by the startup seed, so each worker keeps the
+# sorted list for a minute. Instances are detached from the loading session
+# and only their column attributes are read.
+_category_cache: TTLCache = TTLCache(maxsize=1, ttl=60)
+_category_lock = asyncio.Lock()
+
+
+async def _get_categories(session: AsyncSession) -> list[Category]:
+    cats = _category_cache.get("all")
+    if cats is None:
+        async with _category_lock:
+            # Another request may have filled it while we waited
+            cats = _category_cache.get("all")
+            if cats is None:
+                cats = list((await session.execute(select(Category).order_by(Category.name))).scalars().all())
+                for c in cats:
+                    session.expunge(c)
+                _category_cache["all"] = cats
+    return cats
 
 
 @router.get("/forum", response_class=HTMLResponse)
@@ -38,27 +107,32 @@ async def forum_index(request: Request, cat: str | None = Query(None), session:
     # Public view; new thread requires auth
     ctx = {"request": request, "title": "Forum", "cat": cat}
     # Load categories for sidebar
-    result = await session.execute(select(Category).order_by(Category.name))
-    ctx["categories"] = result.scalars().all()
-    return templates.TemplateResponse("forum_index.html", ctx)
+    ctx["categories"] = await _get_categories(session)
+    return render("forum_index.html", ctx)
 
 
 @router.get("/forum/threads", response_class=HTMLResponse)
 async def forum_threads(request: Request, session: AsyncSession = Depends(get_session), cat: str | None = Query(None)):
-    # Load latest threads; compute simple excerpt and replies count
+    # Load latest threads; compute simple excerpt and replies count. The count
+    # is a correlated subquery so the wide body column never enters a GROUP BY.
+    replies_count = (
+        select(func.count(Reply.id)).where(Reply.thread_id == Thread.id).correlate(Thread).scalar_subquery()
+    )
     stmt = select(
         Thread.id,
         Thread.title,
-        Thread.body,
-        func.count(Reply.id).label("replies_count"),
-    ).join(Reply, Reply.thread_id == Thread.id, isouter=True)
+        # Only the excerpt is shown: fetch one character past it, enough to
+        # know whether to add the ellipsis
+        func.substr(Thread.body, 1, 161).label("body"),
+        replies_count.label("replies_count"),
+    )
     if cat:
-        stmt = (
-            stmt.join(ThreadCategory, ThreadCategory.thread_id == Thread.id, isouter=True)
-                .join(Category, Category.id == ThreadCategory.category_id, isouter=True)
-                .where(Category.slug == cat)
-        )
-    stmt = stmt.group_by(Thread.id, Thread.title, Thread.body).order_by(desc(Thread.created_at)).limit(20)
+        stmt = stmt.where(exists().where(
+            ThreadCategory.thread_id == Thread.id,
+            ThreadCategory.category_id == Category.id,
+            Category.slug == cat,
+        ))
+    stmt = stmt.order_by(desc(Thread.created_at)).limit(20)
     result = await session.execute(stmt)
     rows = result.all()
     threads = [
@@ -70,7 +144,7 @@ async def forum_threads(request: Request, session: AsyncSession = Depends(get_se
         }
         for row in rows
     ]
-    return templates.TemplateResponse("partials/_threads.html", {"request": request, "threads": threads})
+    return render("partials/_threads.html", {"request": request, "threads": threads})
 
 
 @router.get("/forum/new", response_class=HTMLResponse)
@@ -78,9 +152,8 @@ async def forum_new(request: Request, session: AsyncSession = Depends(get_sessio
     # Require auth to view form
     if not getattr(request.state, "user", None):
         return RedirectResponse(url=f"/login?next={request.url.path}", status_code=302)
-    from app.core.config import settings
-    cats = (await session.execute(select(Category).order_by(Category.name))).scalars().all()
-    return templates.TemplateResponse(
+    cats = await _get_categories(session)
+    return render(
         "forum_new.html",
         {"request": request, "title": "New Thread", "turnstile_site_key": settings.TURNSTILE_SITE_KEY, "categories": cats},
     )
@@ -101,8 +174,7 @@ async def forum_new_submit(
     # Verify Turnstile
     ok = await verify_turnstile(cf_token)
     if not ok:
-        from app.core.config import settings
-        return templates.TemplateResponse(
+        return render(
             "forum_new.html",
             {"request": request, "title": "New Thread", "error": "Failed challenge. Please try again.", "turnstile_site_key": settings.TURNSTILE_SITE_KEY},
             status_code=400,
@@ -110,83 +182,97 @@ async def forum_new_submit(
     title = (title or "").strip()
     body = (body or "").strip()
     if not title or not body:
-        from app.core.config import settings
-        return templates.TemplateResponse(
+        return render(
             "forum_new.html",
             {"request": request, "title": "New Thread", "error": "Title and body are required.", "turnstile_site_key": settings.TURNSTILE_SITE_KEY},
             status_code=400,
         )
-    t = Thread(title=title, body=body, user_id=user.id)
+    t = Thread(title=title, body=body, body_hash=_body_hash(body), body_html=render_markdown(body), user_id=user.id)
     session.add(t)
     await session.flush()
     # Attach category if provided
     if category:
-        cat = (await session.execute(select(Category).where(Category.slug == category))).scalar_one_or_none()
+        cat = next((c for c in await _get_categories(session) if c.slug == category), None)
         if cat:
             session.add(ThreadCategory(thread_id=t.id, category_id=cat.id))
     await session.commit()
     return RedirectResponse(url="/forum", status_code=302)
 
 
+def _on_thread(model, thread_id: int):
+    # Vote/Reaction rows for a thread and any of its replies. Replies are matched
+    # by subquery so the reply ids needn't be fetched first.
+    reply_ids = select(Reply.id).where(Reply.thread_id == thread_id).scalar_subquery()
+    return or_(
+        and_(model.entity_type == EntityType.THREAD, model.entity_id == thread_id),
+        and_(model.entity_type == EntityType.REPLY, model.entity_id.in_(reply_ids)),
+    )
+
+
 @router.get("/forum/thread/{thread_id}", response_class=HTMLResponse)
 async def forum_thread_view(request: Request, thread_id: int, session: AsyncSession = Depends(get_session)):
-    t = await session.get(Thread, thread_id)
-    if not t:
-        return templates.TemplateResponse(
+    # Thread and its (optional) category in one round-trip
+    row = (await session.execute(
+        select(Thread, Category)
+        .options(undefer(Thread.body_html))
+        .outerjoin(ThreadCategory, ThreadCategory.thread_id == Thread.id)
+        .outerjoin(Category, Category.id == ThreadCategory.category_id)
+        .where(Thread.id == thread_id)
+    )).first()
+    if not row:
+        return render(
             "error.html",
             {"request": request, "title": "404 Error", "code": 404, "message": "Thread not found"},
             status_code=404,
         )
-    # Category
-    cat = (await session.execute(
-        select(Category).join(ThreadCategory, ThreadCategory.category_id == Category.id).where(ThreadCategory.thread_id == thread_id)
-    )).scalar_one_or_none()
-    # Replies
-    result = await session.execute(select(Reply).where(Reply.thread_id == thread_id).order_by(Reply.created_at))
+    t, cat = row
+    # All on the request's session: a page view holds one pooled connection
+    result = await session.execute(
+        select(Reply).options(undefer(Reply.body_html)).where(Reply.thread_id == thread_id).order_by(Reply.created_at)
+    )
+    vote_rows = (await session.execute(
+        select(Vote.entity_type, Vote.entity_id, func.coalesce(func.sum(Vote.value), 0)).where(_on_thread(Vote, thread_id)).group_by(Vote.entity_type, Vote.entity_id)
+    )).all()
+    reaction_rows = (await session.execute(
+        select(Reaction.entity_type, Reaction.entity_id, Reaction.key, func.count(Reaction.id)).where(_on_thread(Reaction, thread_id)).group_by(Reaction.entity_type, Reaction.entity_id, Reaction.key)
+    )).all()
     replies = result.scalars().all()
-    reply_ids = [r.id for r in replies]
-    # Votes
-    thread_score = (await session.execute(
-        select(func.coalesce(func.sum(Vote.value), 0)).where(and_(Vote.entity_type == "thread", Vote.entity_id == thread_id))
-    )).scalar_one()
+    await _ensure_html(session, t, replies)
+    thread_score = 0
     reply_scores = {}
-    if reply_ids:
-        rows = (await session.execute(
-            select(Vote.entity_id, func.coalesce(func.sum(Vote.value), 0)).where(and_(Vote.entity_type == "reply", Vote.entity_id.in_(reply_ids))).group_by(Vote.entity_id)
-        )).all()
-        reply_scores = {rid: score for rid, score in rows}
-    # Reactions
-    thread_reactions = (await session.execute(
-        select(Reaction.key, func.count(Reaction.id)).where(and_(Reaction.entity_type == "thread", Reaction.entity_id == thread_id)).group_by(Reaction.key)
-    )).all()
+    for etype, eid, score in vote_rows:
+        if etype == EntityType.THREAD:
+            thread_score = score
+        else:
+            reply_scores[eid] = score
+    thread_reactions = {}
     reply_reactions = {}
-    if reply_ids:
-        rows = (await session.execute(
-            select(Reaction.entity_id, Reaction.key, func.count(Reaction.id)).where(and_(Reaction.entity_type == "reply", Reaction.entity_id.in_(reply_ids))).group_by(Reaction.entity_id, Reaction.key)
-        )).all()
-        for rid, key, cnt in rows:
-            reply_reactions.setdefault(rid, {})[key] = cnt
+    for etype, eid, key, cnt in reaction_rows:
+        if etype == EntityType.THREAD:
+            thread_reactions[key] = cnt
+        else:
+            reply_reactions.setdefault(eid, {})[key] = cnt
     ctx = {
         "request": request,
         "title": t.title,
         "thread": t,
         "category": cat,
-        "thread_html": render_markdown(t.body),
+        "thread_html": t.body_html,
         "replies": [
             {
                 "id": r.id,
                 "user_id": r.user_id,
                 "created_at": r.created_at,
-                "body_html": render_markdown(r.body),
+                "body_html": r.body_html,
                 "score": int(reply_scores.get(r.id, 0)),
                 "reactions": reply_reactions.get(r.id, {}),
             }
             for r in replies
         ],
         "thread_score": int(thread_score or 0),
-        "thread_reactions": {k: v for k, v in thread_reactions},
+        "thread_reactions": thread_reactions,
     }
-    return templates.TemplateResponse("forum_thread.html", ctx)
+    return render("forum_thread.html", ctx)
 
 
 @router.post("/forum/thread/{thread_id}/reply")
@@ -204,28 +290,30 @@ async def forum_thread_reply(
         return RedirectResponse(url="/forum", status_code=302)
     body = (body or "").strip()
     if not body:
+        await session.refresh(t, ["body_html"])
         result = await session.execute(
-            select(Reply).where(Reply.thread_id == thread_id).order_by(Reply.created_at)
+            select(Reply).options(undefer(Reply.body_html)).where(Reply.thread_id == thread_id).order_by(Reply.created_at)
         )
         replies = result.scalars().all()
+        await _ensure_html(session, t, replies)
         ctx = {
             "request": request,
             "title": t.title,
             "thread": t,
-            "thread_html": render_markdown(t.body),
+            "thread_html": t.body_html,
             "error": "Reply cannot be empty.",
             "replies": [
                 {
                     "id": r.id,
                     "user_id": r.user_id,
                     "created_at": r.created_at,
-                    "body_html": render_markdown(r.body),
+                    "body_html": r.body_html,
                 }
                 for r in replies
             ],
         }
-        return templates.TemplateResponse("forum_thread.html", ctx, status_code=400)
-    r = Reply(thread_id=thread_id, user_id=user.id, body=body)
+        return render("forum_thread.html", ctx, status_code=400)
+    r = Reply(thread_id=thread_id, user_id=user.id, body=body, body_hash=_body_hash(body), body_html=render_markdown(body))
     session.add(r)
     await session.commit()
     return RedirectResponse(url=f"/forum/thread/{thread_id}#reply-{r.id}", status_code=302)
@@ -240,10 +328,10 @@ async def forum_thread_edit(request: Request, thread_id: int, session: AsyncSess
     user = getattr(request.state, "user", None)
     if not user:
         return RedirectResponse(url=f"/login?next=/forum/thread/{thread_id}", status_code=302)
-    t = await session.get(Thread, thread_id)
+    t = await session.get(Thread, thread_id, options=[undefer(Thread.body)])
     if not t or t.user_id != user.id:
         return RedirectResponse(url=f"/forum/thread/{thread_id}", status_code=302)
-    return templates.TemplateResponse("forum_thread_edit.html", {"request": request, "title": f"Edit: {t.title}", "thread": t})
+    return render("forum_thread_edit.html", {"request": request, "title": f"Edit: {t.title}", "thread": t})
 
 
 @router.post("/forum/thread/{thread_id}/edit")
@@ -254,9 +342,21 @@ async def forum_thread_edit_submit(request: Request, thread_id: int, title: str
     t = await session.get(Thread, thread_id)
     if not t or t.user_id != user.id:
         return RedirectResponse(url=f"/forum/thread/{thread_id}", status_code=302)
-    t.title = (title or "").strip()
-    t.body = (body or "").strip()
-    await session.commit()
+    title = (title or "").strip()
+    body = (body or "").strip()
+    body_hash = _body_hash(body)
+    # Saving the form unchanged shouldn't write (or re-render) anything
+    changed = False
+    if title != t.title:
+        t.title = title
+        changed = True
+    if body_hash != t.body_hash:
+        t.body = body
+        t.body_hash = body_hash
+        t.body_html = render_markdown(body)
+        changed = True
+    if changed:
+        await session.commit()
     return RedirectResponse(url=f"/forum/thread/{thread_id}", status_code=302)
 
 
@@ -265,10 +365,10 @@ async def forum_reply_edit(request: Request, reply_id: int, session: AsyncSessio
     user = getattr(request.state, "user", None)
     if not user:
         return RedirectResponse(url=f"/login", status_code=302)
-    r = await session.get(Reply, reply_id)
+    r = await session.get(Reply, reply_id, options=[undefer(Reply.body)])
     if not r or r.user_id != user.id:
         return RedirectResponse(url=f"/forum", status_code=302)
-    return templates.TemplateResponse("forum_reply_edit.html", {"request": request, "title": "Edit reply", "reply": r})
+    return render("forum_reply_edit.html", {"request": request, "title": "Edit reply", "reply": r})
 
 
 @router.post("/forum/reply/{reply_id}/edit")
@@ -279,8 +379,13 @@ async def forum_reply_edit_submit(request: Request, reply_id: int, body: str = F
     r = await session.get(Reply, reply_id)
     if not r or r.user_id != user.id:
         return RedirectResponse(url=f"/forum", status_code=302)
-    r.body = (body or "").strip()
-    await session.commit()
+    body = (body or "").strip()
+    body_hash = _body_hash(body)
+    if body_hash != r.body_hash:
+        r.body = body
+        r.body_hash = body_hash
+        r.body_html = render_markdown(body)
+        await session.commit()
     return RedirectResponse(url=f"/forum/thread/{r.thread_id}#reply-{r.id}", status_code=302)
 
 
@@ -288,8 +393,56 @@ async def forum_reply_edit_submit(request: Request, reply_id: int, body: str = F
 # Votes & Reactions
 # -----------------
 
-def _toggle_vote_sql(entity_type: str, entity_id: int, user_id: int, value: int):
-    return entity_type, entity_id, user_id, value
+async def _toggle_vote(session: AsyncSession, entity_type: int, entity_id: int, user_id: int, value: int) -> None:
+    # Insert, or flip an opposite vote, in one statement. Nothing comes back
+    # only when the same vote already exists, which means "take it back".
+    stmt = (
+        pg_insert(Vote)
+        .values(entity_type=entity_type, entity_id=entity_id, user_id=user_id, value=value)
+        .on_conflict_do_update(
+            index_elements=[Vote.entity_type, Vote.entity_id, Vote.user_id],
+            set_={"value": value},
+            where=Vote.value != value,
+        )
+        .returning(Vote.id)
+    )
+    if (await session.execute(stmt)).first() is None:
+        await session.execute(delete(Vote).where(
+            Vote.entity_type == entity_type, Vote.entity_id == entity_id, Vote.user_id == user_id, Vote.value == value
+        ))
+    await session.commit()
+
+
+async def _toggle_reaction(session: AsyncSession, entity_type: int, entity_id: int, user_id: int, key: str) -> None:
+    stmt = (
+        pg_insert(Reaction)
+        .values(entity_type=entity_type, entity_id=entity_id, user_id=user_id, key=key)
+        .on_conflict_do_nothing(index_elements=[Reaction.entity_type, Reaction.entity_id, Reaction.user_id, Reaction.key])
+        .returning(Reaction.id)
+    )
+    if (await session.execute(stmt)).first() is None:
+        await session.execute(delete(Reaction).where(
+            Reaction.entity_type == entity_type, Reaction.entity_id == entity_id, Reaction.user_id == user_id, Reaction.key == key
+        ))
+    await session.commit()
+
+
+_THREAD_PATH_RE = re.compile(r"/forum/thread/(\d+)")
+
+
+async def _reply_thread_id(request: Request, session: AsyncSession, reply_id: int, thread_id: int | None) -> int | None:
+    # Where to send the user back to after acting on a reply. The thread page
+    # posts thread_id with the form; otherwise use a same-site thread Referer,
+    # and only then look the reply up.
+    if thread_id:
+        return thread_id
+    referer = request.headers.get("referer")
+    if referer:
+        parts = urlsplit(referer)
+        m = _THREAD_PATH_RE.fullmatch(parts.path)
+        if m and parts.netloc == request.url.netloc:
+            return int(m.group(1))
+    return await session.scalar(select(Reply.thread_id).where(Reply.id == reply_id))
 
 
 @router.post("/forum/thread/{thread_id}/vote")
@@ -298,50 +451,37 @@ async def forum_thread_vote(request: Request, thread_id: int, action: str = Form
     if not user:
         return RedirectResponse(url=f"/login?next=/forum/thread/{thread_id}", status_code=302)
     v = 1 if action == "up" else -1
-    # Fetch existing
-    row = (await session.execute(select(Vote).where(and_(Vote.entity_type == "thread", Vote.entity_id == thread_id, Vote.user_id == user.id)))).scalar_one_or_none()
-    if row and row.value == v:
-        await session.delete(row)
-    elif row:
-        row.value = v
-    else:
-        session.add(Vote(entity_type="thread", entity_id=thread_id, user_id=user.id, value=v))
-    await session.commit()
+    await _toggle_vote(session, EntityType.THREAD, thread_id, user.id, v)
     return RedirectResponse(url=f"/forum/thread/{thread_id}", status_code=302)
 
 
 @router.post("/forum/reply/{reply_id}/vote")
-async def forum_reply_vote(request: Request, reply_id: int, action: str = Form(...), session: AsyncSession = Depends(get_session)):
+async def forum_reply_vote(request: Request, reply_id: int, action: str = Form(...), thread_id: int | None = Form(None), session: AsyncSession = Depends(get_session)):
     user = getattr(request.state, "user", None)
     if not user:
         return RedirectResponse(url=f"/login", status_code=302)
     v = 1 if action == "up" else -1
-    row = (await session.execute(select(Vote).where(and_(Vote.entity_type == "reply", Vote.entity_id == reply_id, Vote.user_id == user.id)))).scalar_one_or_none()
-    if row and row.value == v:
-        await session.delete(row)
-    elif row:
-        row.value = v
-    else:
-        session.add(Vote(entity_type="reply", entity_id=reply_id, user_id=user.id, value=v))
-    await session.commit()
-    # Find thread id to redirect
-    r = await session.get(Reply, reply_id)
-    return RedirectResponse(url=f"/forum/thread/{r.thread_id}#reply-{reply_id}", status_code=302)
+    await _toggle_vote(session, EntityType.REPLY, reply_id, user.id, v)
+    thread_id = await _reply_thread_id(request, session, reply_id, thread_id)
+    if thread_id is None:
+        return RedirectResponse(url="/forum", status_code=302)
+    return RedirectResponse(url=f"/forum/thread/{thread_id}#reply-{reply_id}", status_code=302)
 
 
 @router.post("/forum/{entity}/{entity_id}/react")
-async def forum_react(request: Request, entity: str, entity_id: int, key: str = Form(...), session: AsyncSession = Depends(get_session)):
+async def forum_react(request: Request, entity: str, entity_id: int, key: str = Form(...), thread_id: int | None = Form(None), session: AsyncSession = Depends(get_session)):
     if entity not in {"thread", "reply"}:
         return RedirectResponse(url="/forum", status_code=302)
     user = getattr(request.state, "user", None)
     if not user:
         return RedirectResponse(url=f"/login", status_code=302)
-    row = (await session.execute(select(Reaction).where(and_(Reaction.entity_type == entity, Reaction.entity_id == entity_id, Reaction.user_id == user.id, Reaction.key == key)))).scalar_one_or_none()
-    if row:
-        await session.delete(row)
-    else:
-        session.add(Reaction(entity_type=entity, entity_id=entity_id, user_id=user.id, key=key))
-    await session.commit()
+    entity_type = EntityType[entity.upper()]
+    await _toggle_reaction(session, entity_type, entity_id, user.id, key)
     # Redirect back to thread view
-    thread_id = entity_id if entity == "thread" else (await session.get(Reply, entity_id)).thread_id
+    if entity == "thread":
+        thread_id = entity_id
+    else:
+        thread_id = await _reply_thread_id(request, session, entity_id, thread_id)
+        if thread_id is None:
+            return RedirectResponse(url="/forum", status_code=302)
     return RedirectResponse(url=f"/forum/thread/{thread_id}", status_code=302)
@@ -1,22 +1,23 @@
-from pathlib import Path
+import hashlib
 from fastapi import APIRouter, Depends, Form, Request
 from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from markdown_it import MarkdownIt
-import bleach
-from bs4 import BeautifulSoup
+from markdown_it.common.utils import escapeHtml
 
 from app.core.db import get_session
 from app.core.models.resume import Resume
+from app.web.markup import make_sanitizer, plain_paragraph
+from app.web.templating import preload, render
 
 router = APIRouter()
 
-TEMPLATES_DIR = Path(__file__).resolve().parent.parent / "templates"
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+preload("resume.html", "resume_edit.html", "error.html")
 
 # Markdown rendering and sanitization (reuse forum settings)
+# Raw HTML in posts is passed through and left to the sanitizer, which keeps
+# the allowed tags below
 _md = MarkdownIt()
 _ALLOWED_TAGS = [
     "p", "br", "hr", "pre", "code", "blockquote",
@@ -29,54 +30,72 @@ _ALLOWED_ATTRS = {
     "img": ["src", "alt", "title"]
 }
 
-def _wrap_images_with_links(html: str) -> str:
-    soup = BeautifulSoup(html, 'html.parser')
-    for img in soup.find_all('img'): 
-        if img.find_parent('a'):
-            continue  # already linked by author
-        src = img.get('src')
-        if not src:
-            continue
-        a = soup.new_tag('a', href=src)
-        a['target'] = '_blank'
-        a['rel'] = 'noopener nofollow'
-        img.replace_with(a)
-        a.append(img)
-    return str(soup)
-
-def _force_links_new_tab(html: str) -> str:
-    soup = BeautifulSoup(html, 'html.parser')
-    for a in soup.find_all('a'):
-        href = (a.get('href') or '').strip()
-        if not href:
-            continue
-        # Open every link in a new tab and set safe rel
-        a['target'] = '_blank'
-        a['rel'] = 'noopener nofollow'
-    return str(soup)
-    
+_sanitize = make_sanitizer(_ALLOWED_TAGS, _ALLOWED_ATTRS)
+
+
+# Links and images are rewritten at render time: every link opens in a new
+# tab, and images not already inside a link are wrapped in one to the image
+# itself so clicking opens it in a new tab.
+_NEW_TAB = ' target="_blank" rel="noopener nofollow"'
+
+
+def _render_link_open(self, tokens, idx, options, env):
+    token = tokens[idx]
+    if (token.attrGet("href") or "").strip():
+        token.attrSet("target", "_blank")
+        token.attrSet("rel", "noopener nofollow")
+    return self.renderToken(tokens, idx, options, env)
+
+
+def _render_image(self, tokens, idx, options, env):
+    html = self.image(tokens, idx, options, env)
+    src = tokens[idx].attrGet("src")
+    if not src:
+        return html
+    depth = 0
+    for tok in tokens[:idx]:
+        if tok.type == "link_open":
+            depth += 1
+        elif tok.type == "link_close":
+            depth -= 1
+    if depth > 0:
+        return html  # already linked by author
+    return f'<a href="{escapeHtml(src)}"{_NEW_TAB}>{html}</a>'
+
+
+_md.add_render_rule("link_open", _render_link_open)
+_md.add_render_rule("image", _render_image)
+
+
 def render_markdown(text: str) -> str:
-    html = _md.render(text or "")
-    # Wrap images with links so images open in a new tab when clicked
-    html = _wrap_images_with_links(html)
-    # Force links to open in a new tab
-    html = _force_links_new_tab(html)
-    # Sanitize after wrapping to ensure allowed tags/attrs only
-    return bleach.clean(html, tags=_ALLOWED_TAGS, attributes=_ALLOWED_ATTRS, strip=True, protocols=["http", "https", "mailto"])
+    text = text or ""
+    if not text.strip():
+        return ""
+    html = plain_paragraph(text)
+    if html is not None:
+        return html
+    # Sanitize the rendered output to ensure allowed tags/attrs only
+    return _sanitize(_md.render(text))
 
 
 @router.get("/resume", response_class=HTMLResponse)
 async def resume_view(request: Request, session: AsyncSession = Depends(get_session)):
     result = await session.execute(select(Resume).limit(1))
     resume = result.scalar_one_or_none()
-    resume_html = render_markdown(resume.content if resume else "")
+    resume_html = ""
+    if resume:
+        if resume.content_html is None:
+            # Saved before content_html existed; render once and keep it
+            resume.content_html = render_markdown(resume.content)
+            await session.commit()
+        resume_html = resume.content_html
     ctx = {
         "request": request,
         "title": "Resume",
         "resume": resume,
         "resume_html": resume_html,
     }
-    return templates.TemplateResponse("resume.html", ctx)
+    return render("resume.html", ctx)
 
 
 @router.get("/resume/edit", response_class=HTMLResponse)
@@ -85,14 +104,14 @@ async def resume_edit_page(request: Request, session: AsyncSession = Depends(get
     if not user:
         return RedirectResponse(url="/login?next=/resume/edit", status_code=302)
     if getattr(user, "role", "user") != "owner":
-        return templates.TemplateResponse(
+        return render(
             "error.html",
             {"request": request, "title": "403 Error", "code": 403, "message": "Only the site owner can edit the resume."},
             status_code=403,
         )
     result = await session.execute(select(Resume).limit(1))
     resume = result.scalar_one_or_none()
-    return templates.TemplateResponse("resume_edit.html", {"request": request, "title": "Edit Resume", "resume": resume})
+    return render("resume_edit.html", {"request": request, "title": "Edit Resume", "resume": resume})
 
 
 @router.post("/resume/edit")
@@ -101,19 +120,23 @@ async def resume_edit_submit(request: Request, content: str = Form(""), session:
     if not user:
         return RedirectResponse(url="/login?next=/resume/edit", status_code=302)
     if getattr(user, "role", "user") != "owner":
-        return templates.TemplateResponse(
+        return render(
             "error.html",
             {"request": request, "title": "403 Error", "code": 403, "message": "Only the site owner can edit the resume."},
             status_code=403,
         )
     content = (content or "").strip()
+    content_hash = hashlib.blake2b(content.encode(), digest_size=16).digest()
     result = await session.execute(select(Resume).limit(1))
     resume = result.scalar_one_or_none()
     if not resume:
-        resume = Resume(content=content, updated_by=user.id)
+        resume = Resume(content=content, content_hash=content_hash, content_html=render_markdown(content), updated_by=user.id)
         session.add(resume)
-    else:
+        await session.commit()
+    elif content_hash != resume.content_hash:
         resume.content = content
+        resume.content_hash = content_hash
+        resume.content_html = render_markdown(content)
         resume.updated_by = user.id
-    await session.commit()
+        await session.commit()
     return RedirectResponse(url="/resume", status_code=302)
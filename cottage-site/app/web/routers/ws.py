@@ -1,12 +1,12 @@
 import asyncio
-import json
-from pathlib import Path
 import time
 from uuid import uuid4
 from typing import Optional
 
+import orjson
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 
+from app.core.avatars import avatar_url
 from app.core.redis_client import get_redis
 from app.core.db import AsyncSessionLocal
 from app.core.security import get_user_from_websocket
@@ -16,23 +16,81 @@ router = APIRouter()
 
 CHANNEL_NAME = "chat:global"
 HISTORY_KEY = "chat:global:history"
+HISTORY_SIZE = 50
+# Max messages queued for one client before the oldest are dropped
+OUTBOX_SIZE = 256
 
-# Avatars live under app/web/static/avatars
-STATIC_DIR = Path(__file__).resolve().parents[1] / "static"
-AVATAR_DIR = STATIC_DIR / "avatars"
+# Largest integer a JS client can represent exactly
+_MAX_SAFE_INT = 2**53 - 1
 
 
-def _avatar_url(user_id: Optional[int]) -> Optional[str]:
-    try:
-        if not user_id:
-            return None
-        p = (AVATAR_DIR / f"{user_id}.webp")
-        if not p.exists():
-            return None
-        ts = int(p.stat().st_mtime)
-        return f"/static/avatars/{user_id}.webp?v={ts}"
-    except Exception:
-        return None
+def _dumps(obj) -> str:
+    # orjson returns bytes; the client reads text frames
+    return orjson.dumps(obj).decode()
+
+
+def _client_id(value):
+    # Echoed back and broadcast with the message: only short strings or
+    # integers a JS client can represent, anything else is dropped
+    if isinstance(value, str):
+        return value[:64]
+    if isinstance(value, int) and not isinstance(value, bool) and -_MAX_SAFE_INT <= value <= _MAX_SAFE_INT:
+        return value
+    return None
+
+
+# Per-sender rate limiting, run atomically in Redis in one round-trip.
+# Allows 5 messages per 10s; each message over the limit is a strike (strikes
+# last 2 minutes) and requires a Turnstile challenge, and the third strike
+# blocks the sender for a minute.
+# KEYS: block, count, strikes, challenge
+# Returns {status, retry_after, require_challenge}
+_RATE_LIMIT_LUA = """
+local ttl = redis.call('TTL', KEYS[1])
+if ttl > 0 then
+  return {1, ttl, 0}
+end
+local cnt = redis.call('INCR', KEYS[2])
+if cnt == 1 then
+  redis.call('EXPIRE', KEYS[2], 10)
+end
+local challenge = redis.call('EXISTS', KEYS[4])
+if cnt > 5 then
+  local strikes = redis.call('INCR', KEYS[3])
+  if strikes == 1 then
+    redis.call('EXPIRE', KEYS[3], 120)
+  end
+  if strikes >= 3 then
+    redis.call('SET', KEYS[1], 1, 'EX', 60)
+    return {2, 60, 0}
+  end
+  redis.call('SET', KEYS[4], 1, 'EX', 120)
+  challenge = 1
+end
+return {0, 0, challenge}
+"""
+_RL_BLOCKED = 1  # already blocked
+_RL_NEWLY_BLOCKED = 2  # third strike just now
+
+# Publish a chat event and append it to the capped history in one atomic
+# call, so readers never see the list over its cap.
+# KEYS: history; ARGV: channel, event, max history length
+_PUBLISH_LUA = """
+redis.call('LPUSH', KEYS[1], ARGV[2])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+return redis.call('PUBLISH', ARGV[1], ARGV[2])
+"""
+
+# Lua source -> registered Script
+_scripts: dict = {}
+
+
+def _script(redis, source: str):
+    # Script objects run EVALSHA and fall back to EVAL if the server lost it
+    script = _scripts.get(source)
+    if script is None or script.registered_client is not redis:
+        script = _scripts[source] = redis.register_script(source)
+    return script
 
 
 @router.websocket("/ws/chat")
@@ -49,165 +107,158 @@ async def chat_ws(websocket: WebSocket):
 
     # Send last 50 messages as history on connect (oldest -> newest)
     try:
-        raw = await redis.lrange(HISTORY_KEY, 0, 49)
-        history = []
-        for item in reversed(raw):  # reverse to oldest-first for display
-            if isinstance(item, bytes):
-                item = item.decode("utf-8", errors="ignore")
-            try:
-                history.append(json.loads(item))
-            except Exception:
-                pass
-        await websocket.send_text(json.dumps({"type": "history", "items": history}))
+        raw = await redis.lrange(HISTORY_KEY, 0, HISTORY_SIZE - 1)
+        raw.reverse()  # oldest-first for display
+        if all(item[:1] == "{" and item[-1:] == "}" for item in raw):
+            # Entries are the JSON we stored; splice them in without a
+            # decode/encode round-trip
+            await websocket.send_text('{"type":"history","items":[' + ",".join(raw) + "]}")
+        else:
+            history = []
+            for item in raw:
+                try:
+                    history.append(orjson.loads(item))
+                except Exception:
+                    pass
+            await websocket.send_text(_dumps({"type": "history", "items": history}))
     except Exception:
         pass
 
+    # Pubsub messages waiting to go out. Bounded so a slow client can't make
+    # us buffer without limit; when it's full the oldest message is dropped.
+    outbox: asyncio.Queue = asyncio.Queue(maxsize=OUTBOX_SIZE)
+
     async def reader():
-        try:
-            async for message in pubsub.listen():
-                if message is None:
-                    continue
-                if message.get("type") != "message":
-                    continue
-                data = message.get("data")
-                if isinstance(data, bytes):
-                    data = data.decode("utf-8", errors="ignore")
-                await websocket.send_text(data)
-        except Exception:
-            # Connection closed or pubsub error
-            pass
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                continue
+            data = message.get("data")
+            if isinstance(data, bytes):
+                data = data.decode("utf-8", errors="ignore")
+            if outbox.full():
+                outbox.get_nowait()
+            outbox.put_nowait(data)
+
+    async def sender():
+        while True:
+            items = [await outbox.get()]
+            # Whatever piled up while the last frame was being sent goes
+            # out together in one batch frame
+            while not outbox.empty():
+                items.append(outbox.get_nowait())
+            if len(items) == 1:
+                await websocket.send_text(items[0])
+            else:
+                # Items are already-encoded JSON events
+                await websocket.send_text('{"type":"batch","items":[' + ",".join(items) + "]}")
 
     async def writer():
-        try:
-            while True:
-                text = await websocket.receive_text()
+        while True:
+            text = await websocket.receive_text()
+            try:
+                payload = orjson.loads(text)
+                # Ignore client-provided username; use authenticated user's display name
+                msg_text = str(payload.get("text") or "").strip()
+                ts = int(payload.get("ts") or 0) or int(time.time() * 1000)
+                client_id = _client_id(payload.get("id"))
+            except Exception:
+                msg_text = text
+                ts = int(time.time() * 1000)
+                client_id = None
+            if not -_MAX_SAFE_INT <= ts <= _MAX_SAFE_INT:
+                # Out of range for orjson (and for JS numbers on the other end)
+                ts = int(time.time() * 1000)
+            if not msg_text:
+                continue
+            # Only authenticated users may send
+            if not display_name:
+                continue
+            # Validate message length (max 2000 chars)
+            if len(msg_text) > 2000:
                 try:
-                    payload = json.loads(text)
-                    # Ignore client-provided username; use authenticated user's display name
-                    msg_text = str(payload.get("text") or "").strip()
-                    ts = int(payload.get("ts") or 0) or int(__import__("time").time() * 1000)
-                    client_id = payload.get("id")
+                    await websocket.send_text(_dumps({"type": "error", "error": "Message exceeds 2000 characters.", "code": "too_long", "client_id": client_id}))
                 except Exception:
-                    msg_text = text
-                    ts = int(__import__("time").time() * 1000)
-                    client_id = None
-                if not msg_text:
-                    continue
-                # Only authenticated users may send
-                if not display_name:
-                    continue
-                # Validate message length (max 2000 chars)
-                if len(msg_text) > 2000:
+                    pass
+                continue
+            # --- Rate limiting & anti-abuse ---
+            try:
+                sender_key = f"user:{getattr(user, 'id', None)}" if user else f"ip:{getattr(websocket.client, 'host', 'unknown')}"
+                block_key = f"chat:block:{sender_key}"
+                count_key = f"chat:count:{sender_key}"
+                strikes_key = f"chat:strikes:{sender_key}"
+                challenge_key = f"chat:challenge:{sender_key}"
+
+                status, retry_after, require_challenge = await _script(redis, _RATE_LIMIT_LUA)(
+                    keys=[block_key, count_key, strikes_key, challenge_key]
+                )
+                if status:
+                    if status == _RL_BLOCKED:
+                        error = f"You're sending messages too fast. Temporarily blocked. Try again in {retry_after} seconds."
+                    else:
+                        error = "Temporarily blocked for excessive messaging. Please wait a minute."
                     try:
-                        await websocket.send_text(json.dumps({"type": "error", "error": "Message exceeds 2000 characters.", "code": "too_long", "client_id": client_id}))
+                        await websocket.send_text(_dumps({
+                            "type": "error",
+                            "error": error,
+                            "code": "blocked",
+                            "retry_after": retry_after,
+                            "client_id": client_id,
+                        }))
                     except Exception:
                         pass
                     continue
-                # --- Rate limiting & anti-abuse ---
-                try:
-                    sender_key = f"user:{getattr(user, 'id', None)}" if user else f"ip:{getattr(websocket.client, 'host', 'unknown')}"
-                    block_key = f"chat:block:{sender_key}"
-                    count_key = f"chat:count:{sender_key}"
-                    strikes_key = f"chat:strikes:{sender_key}"
-                    challenge_key = f"chat:challenge:{sender_key}"
-
-                    # If currently blocked, return error with retry time
-                    ttl = await redis.ttl(block_key)
-                    if ttl and ttl > 0:
+
+                # If a Turnstile token is provided, verify it (when challenge required)
+                cf_token = payload.get("cf")
+                if require_challenge:
+                    ok = False
+                    if cf_token:
+                        ok = await verify_turnstile(cf_token, getattr(websocket.client, "host", None) if hasattr(websocket, "client") else None)
+                    if not ok:
                         try:
-                            await websocket.send_text(json.dumps({
+                            await websocket.send_text(_dumps({
                                 "type": "error",
-                                "error": f"You're sending messages too fast. Temporarily blocked. Try again in {ttl} seconds.",
-                                "code": "blocked",
-                                "retry_after": ttl,
+                                "error": "Additional verification required. Please complete the challenge.",
+                                "code": "challenge_required",
                                 "client_id": client_id,
                             }))
                         except Exception:
                             pass
                         continue
+                    else:
+                        try:
+                            await redis.delete(challenge_key)
+                        except Exception:
+                            pass
+            except Exception:
+                # If Redis unavailable, fail-open (no throttle)
+                pass
+            # Attach avatar URL if available
+            avatar = avatar_url(getattr(user, "id", None))
+            event = {"id": str(uuid4()), "user": display_name, "text": msg_text, "ts": ts, "avatar": avatar, "client_id": client_id}
+            encoded = orjson.dumps(event)
+            # Publish and persist to history (LPUSH newest first, keep only
+            # the last HISTORY_SIZE) in one round-trip
+            await _script(redis, _PUBLISH_LUA)(keys=[HISTORY_KEY], args=[CHANNEL_NAME, encoded, HISTORY_SIZE])
 
-                    # Simple burst counter: allow up to 5 messages per 10s
-                    cnt = await redis.incr(count_key)
-                    if cnt == 1:
-                        await redis.expire(count_key, 10)
-
-                    require_challenge = await redis.exists(challenge_key)
-                    if cnt > 5:
-                        strikes = await redis.incr(strikes_key)
-                        if strikes == 1:
-                            await redis.expire(strikes_key, 120)
-                        if strikes >= 3:
-                            await redis.set(block_key, 1, ex=60)
-                            try:
-                                await websocket.send_text(json.dumps({
-                                    "type": "error",
-                                    "error": "Temporarily blocked for excessive messaging. Please wait a minute.",
-                                    "code": "blocked",
-                                    "retry_after": 60,
-                                    "client_id": client_id,
-                                }))
-                            except Exception:
-                                pass
-                            continue
-                        else:
-                            await redis.set(challenge_key, 1, ex=120)
-                            require_challenge = 1
-
-                    # If a Turnstile token is provided, verify it (when challenge required)
-                    cf_token = payload.get("cf")
-                    if require_challenge:
-                        ok = False
-                        if cf_token:
-                            ok = await verify_turnstile(cf_token, getattr(websocket.client, "host", None) if hasattr(websocket, "client") else None)
-                        if not ok:
-                            try:
-                                await websocket.send_text(json.dumps({
-                                    "type": "error",
-                                    "error": "Additional verification required. Please complete the challenge.",
-                                    "code": "challenge_required",
-                                    "client_id": client_id,
-                                }))
-                            except Exception:
-                                pass
-                            continue
-                        else:
-                            try:
-                                await redis.delete(challenge_key)
-                            except Exception:
-                                pass
-                except Exception:
-                    # If Redis unavailable, fail-open (no throttle)
-                    pass
-                # Attach avatar URL if available
-                avatar = _avatar_url(getattr(user, "id", None))
-                event = {"id": str(uuid4()), "user": display_name, "text": msg_text, "ts": ts, "avatar": avatar, "client_id": client_id}
-                encoded = json.dumps(event)
-                await redis.publish(CHANNEL_NAME, encoded)
-                # Persist to history (LPUSH newest first), keep only last 50
-                try:
-                    await redis.lpush(HISTORY_KEY, encoded)
-                    await redis.ltrim(HISTORY_KEY, 0, 49)
-                except Exception:
-                    pass
-        except WebSocketDisconnect:
-            pass
-        except Exception:
-            pass
-
-    reader_task = asyncio.create_task(reader())
-    writer_task = asyncio.create_task(writer())
-
+    # reader/sender/writer loop until the client disconnects or Redis fails;
+    # the first one to raise cancels the others
     try:
-        await asyncio.gather(reader_task, writer_task)
-    except Exception:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(reader())
+            tg.create_task(sender())
+            tg.create_task(writer())
+    except* WebSocketDisconnect:
+        pass
+    except* Exception:
+        # Connection dropped mid-send or pubsub error
         pass
     finally:
-        for task in (reader_task, writer_task):
-            if not task.done():
-                task.cancel()
         try:
-            await pubsub.unsubscribe(CHANNEL_NAME)
-            await pubsub.close()
+            # Drops the pubsub connection rather than handing a subscribed
+            # one back to the pool
+            await pubsub.aclose()
         except Exception:
             pass
         try:
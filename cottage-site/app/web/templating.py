@@ -0,0 +1,24 @@
+from pathlib import Path
+
+from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
+
+from app.core.config import settings
+
+TEMPLATES_DIR = Path(__file__).resolve().parent / "templates"
+templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+# Outside DEBUG templates only change on deploy: skip the per-render mtime
+# check and keep the compiled templates routers render.
+templates.env.auto_reload = settings.DEBUG
+_compiled: dict = {}
+
+
+def preload(*names: str) -> None:
+    # Called by routers at import, so a missing template fails at startup
+    for name in names:
+        _compiled[name] = templates.get_template(name)
+
+
+def render(name: str, ctx: dict, status_code: int = 200) -> HTMLResponse:
+    tpl = templates.get_template(name) if settings.DEBUG else _compiled[name]
+    return HTMLResponse(tpl.render(ctx), status_code=status_code)